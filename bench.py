@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import argparse
+import curses
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import maps
+
+BENCH_SIZES = (50, 100, 200, 500, 1000, 2000)
+BENCH_SEED = 1
+BENCH_REPEAT = 3
+# Json maps take minutes past this size, bigger maps only time the v2 format
+BENCH_JSON_MAX = 200
+# Viewport frames drawn per size: a walk right, down, left and up, then full redraws
+BENCH_STEPS = 40
+# Pyramid level the zoomed out viewport frames are drawn from, 1/16 of the map size
+BENCH_ZOOM = 4
+# A metric regresses when it is this much slower (or bigger) than the baseline, and by more than the noise floor
+BENCH_THRESHOLD = 0.2
+BENCH_MIN_S = 0.002
+BENCH_MIN_BYTES = 1 << 16
+
+# Stand in for a curses window, keeps the text drawn on it so nothing needs a terminal
+class FakeScreen:
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.rows = [[' '] * width for y in range(0, height)]
+        self.top = 0
+        self.bottom = height - 1
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, text, attr=0):
+        self.rows[y][x:x+len(text)] = text
+
+    def border(self, *chars):
+        for row in self.rows:
+            row[0] = row[-1] = '|'
+        self.rows[0] = ['-'] * self.width
+        self.rows[-1] = ['-'] * self.width
+
+    def setscrreg(self, top, bottom):
+        self.top = top
+        self.bottom = bottom
+
+    def scroll(self, lines):
+        blank = [[' '] * self.width for y in range(0, abs(lines))]
+        rows = self.rows[self.top:self.bottom+1]
+        rows = rows[lines:] + blank if lines > 0 else blank + rows[:lines]
+        self.rows[self.top:self.bottom+1] = rows
+
+    def idlok(self, flag):
+        pass
+
+    def scrollok(self, flag):
+        pass
+
+    def erase(self):
+        self.rows = [[' '] * self.width for y in range(0, self.height)]
+
+    def noutrefresh(self):
+        pass
+
+# Progress sink that only records when each stage finishes, to time the stages of one run
+class StageTimer:
+    def __init__(self, stages):
+        self.finished = dict()
+        self.progress = maps.Progress(self.sink, stages, fps=1e-9)
+
+    def sink(self, progress):
+        for name, (label, done, total) in progress.stages.items():
+            if total and done >= total and name not in self.finished:
+                self.finished[name] = progress.elapsed()
+
+    # Time spent in each stage, in the order they finished
+    def times(self):
+        times = dict()
+        last = 0.0
+        for name, end in sorted(self.finished.items(), key=lambda s: s[1]):
+            times[name] = end - last
+            last = end
+        return times
+
+# Best time of repeat runs of fn, then the peak memory of one more run under tracemalloc
+def measure(fn, repeat):
+    best = None
+    for i in range(0, repeat):
+        t = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'s': best, 'peak_bytes': peak}
+
+# Viewport redraws like main's loop: the map window through MapView plus the stats window, on fake screens.
+# Returns the frame times of scrolling moves, of full redraws and of full redraws zoomed out to BENCH_ZOOM
+def bench_viewport(game_objects, steps):
+    midy = int(maps.MAP_HEIGHT / 2)
+    midx = int(maps.MAP_WIDTH / 2)
+    win = FakeScreen(maps.MAP_HEIGHT, maps.MAP_WIDTH)
+    stats = FakeScreen(maps.WIN_HEIGHT, maps.WIN_WIDTH)
+    view = maps.MapView(win, game_objects, midy, midx)
+    # MapView asks curses for colour attributes, which needs a terminal
+    color_pair = curses.color_pair
+    curses.color_pair = lambda n: n << 8
+    try:
+        y = x = 0
+        view.draw(y, x)
+        moves = [(0, 1)] * steps + [(1, 0)] * steps + [(0, -1)] * steps + [(-1, 0)] * steps
+        t = time.perf_counter()
+        for dy, dx in moves:
+            y += dy
+            x += dx
+            view.draw(y, x)
+            stats.erase()
+            stats.addstr(0, 0, 'pos_x:' + str(x) + ' pos_y:' + str(y))
+            stats.noutrefresh()
+        scroll = (time.perf_counter() - t) / len(moves)
+        t = time.perf_counter()
+        for i in range(0, steps):
+            view.invalidate()
+            view.draw(y, x)
+        full = (time.perf_counter() - t) / steps
+        pyramid = maps.MapPyramid(game_objects)
+        view.show(pyramid.level(min(BENCH_ZOOM, pyramid.depth() - 1)))
+        t = time.perf_counter()
+        for i in range(0, steps):
+            view.invalidate()
+            view.draw(y, x)
+        zoomed = (time.perf_counter() - t) / steps
+    finally:
+        curses.color_pair = color_pair
+    return {'scroll_frame_s': scroll, 'full_frame_s': full, 'zoomed_frame_s': zoomed}
+
+# Every metric of one map size, as metric name -> {'s': seconds, 'peak_bytes': bytes (when measured)}
+def bench_size(size, seed, repeat, json_max, workdir):
+    results = dict()
+    midy = int(maps.MAP_HEIGHT / 2)
+    midx = int(maps.MAP_WIDTH / 2)
+    timer = StageTimer(maps.GEN_STAGES)
+    maps.generate_map(size, size, midy, midx, progress=timer.progress, seed=seed)
+    for stage, t in timer.times().items():
+        results['generate.' + stage] = {'s': t}
+    results['generate'] = measure(lambda: maps.generate_map(size, size, midy, midx, seed=seed), repeat)
+    game_objects = maps.generate_map(size, size, midy, midx, seed=seed)
+    formats = [('v2', maps.COMPRESS_ZLIB), ('raw', maps.COMPRESS_NONE), ('chunked', maps.COMPRESS_CHUNKED)]
+    if size <= json_max:
+        formats.append(('json', None))
+    for name, compression in formats:
+        path = os.path.join(workdir, 'bench-' + name + '.map')
+        fmt = 'json' if name == 'json' else 'v2'
+        results['save.' + name] = measure(lambda: maps.write_map(path, game_objects, fmt, compression), repeat)
+        results['load.' + name] = measure(lambda: maps.read_map(path), repeat)
+        if name != 'json':
+            results['load_lazy.' + name] = measure(lambda: maps.read_map(path, lazy=True), repeat)
+    # Every level of the zoom pyramid, down to 1x1
+    depth = maps.MapPyramid(game_objects).depth()
+    results['pyramid'] = measure(lambda: maps.MapPyramid(game_objects).level(depth - 1), repeat)
+    frames = bench_viewport(game_objects, BENCH_STEPS)
+    results['viewport.scroll'] = {'s': frames['scroll_frame_s']}
+    results['viewport.full'] = {'s': frames['full_frame_s']}
+    results['viewport.zoomed'] = {'s': frames['zoomed_frame_s']}
+    return results
+
+# Metrics that got slower or bigger than the baseline by more than threshold (and the noise floors)
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, metrics in results.items():
+        for metric, values in metrics.items():
+            old = baseline.get(size, dict()).get(metric)
+            if old is None:
+                continue
+            for key, floor in (('s', BENCH_MIN_S), ('peak_bytes', BENCH_MIN_BYTES)):
+                if key not in values or key not in old:
+                    continue
+                if values[key] > old[key] * (1 + threshold) and values[key] - old[key] > floor:
+                    regressions.append({'size': int(size), 'metric': metric, 'value': key, 'baseline': old[key],
+                                        'now': values[key], 'ratio': values[key] / old[key] if old[key] else None})
+    return regressions
+
+# bench.py: time and measure generation, saving, loading and viewport drawing for each map size, results go to
+# stdout (or --out) as json. With --baseline the results are compared to an earlier run, regressions fail the run
+def cli(argv):
+    parser = argparse.ArgumentParser(prog='bench.py', description='Benchmark map generation, map files and drawing')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES, help='map sizes (>= 50)')
+    parser.add_argument('--seed', type=int, default=BENCH_SEED, help='seed of the generated maps')
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT, help='timed runs per metric, the best is kept')
+    parser.add_argument('--json-max', type=int, default=BENCH_JSON_MAX, help='largest size to time json maps on')
+    parser.add_argument('--out', help='write the results to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=BENCH_THRESHOLD,
+                        help='allowed slow down before a metric counts as a regression, 0.2 is 20%%')
+    args = parser.parse_args(argv)
+    if min(args.sizes) < 50:
+        sys.stderr.write('error: --sizes must be >= 50\n')
+        return 2
+    report = {'python': platform.python_version(), 'numpy': None if maps.np is None else maps.np.__version__,
+              'seed': args.seed, 'repeat': args.repeat, 'results': dict()}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            t = time.perf_counter()
+            report['results'][str(size)] = bench_size(size, args.seed, args.repeat, args.json_max, workdir)
+            sys.stderr.write(str(size) + 'x' + str(size) + ' %.1fs\n' % (time.perf_counter() - t))
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        report['baseline'] = args.baseline
+        report['regressions'] = compare(report['results'], baseline['results'], args.threshold)
+        for r in report['regressions']:
+            sys.stderr.write('REGRESSION ' + str(r['size']) + ' ' + r['metric'] + ' ' + r['value'] + ': ' +
+                             str(r['baseline']) + ' -> ' + str(r['now']) + '\n')
+        status = 1 if report['regressions'] else 0
+    if args.out:
+        with open(args.out, 'w') as fout:
+            json.dump(report, fout, indent=2)
+            fout.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))
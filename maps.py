@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
+import argparse
+import cProfile
 import time
 import curses
 import random
 import os
+import queue
 import json
+import mmap
 import gzip
+import hashlib
+import html
+import io
+import itertools
 import math
 import re
+import signal
+import struct
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections.abc import Mapping, Sequence
 from datetime import datetime
+import multiprocessing
+from multiprocessing import shared_memory
 from curses import wrapper
+# Numpy is optional, the voronoi engine falls back to pure python when it is missing
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Globals
 WALL_TYPE = 'wall'
@@ -19,6 +42,115 @@ WIN_HEIGHT = 1
 WIN_WIDTH = 80
 MAP_HEIGHT = 24
 MAP_WIDTH = 70
+# Tiles labelled per batch by the voronoi engine, keeps memory bounded on big maps
+VORONOI_CHUNK_CELLS = 1 << 20
+# Carve corridors joining every floor region of new maps to the spawn, so no floor is out of reach
+CONNECT_MAP = False
+# Compute the distance field layers of new maps (see distance_fields), they are saved with v2 maps
+DISTANCE_FIELDS = False
+# Version of the map generator. Anything that changes the map a seed gives must bump it, so cached maps built by
+# an older generator are never handed out
+GENERATOR_VERSION = 1
+MAP_CACHE_DIR = 'resources/cache'
+MAP_CACHE_BYTES = 256 << 20
+# Processes gen_map labels voronoi regions with, 1 does everything in this process
+GEN_WORKERS = 1
+# Map file format used when saving, 'v2' (binary) or 'json' (legacy gzip json shared with maps-rust)
+MAP_FORMAT = 'v2'
+
+# Binary map file (v2): a fixed header followed by the tile chars row by row, optionally zlib compressed.
+# Header fields: magic, version, compression, sizey, sizex, player y, player x, seed, payload length
+MAP_MAGIC = b'CMAP'
+MAP_VERSION = 2
+MAP_HEADER = struct.Struct('<4sHHIIiiQQ')
+# Flag in the high byte of the compression field: the seed field holds the seed the map was generated from.
+# Files written before the flag existed only have a seed when the field is not 0
+MAP_SEEDED = 0x100
+# Seeds are stored as an unsigned 64 bit number, so they go from 0 to SEED_LIMIT - 1
+SEED_LIMIT = 1 << 64
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_CHUNKED = 2
+MAP_COMPRESSION = COMPRESS_ZLIB
+# Extra per tile layers stored after the v2 map payload: name, compression, data length, then one little endian
+# uint32 per tile. Readers that do not know about layers stop at the end of the payload. Layers of chunked maps are
+# chunked too (same chunk header and index as the payload), so a lazily loaded map only decompresses the layer
+# chunks that are used
+LAYER_HEADER = struct.Struct('<16sBQ')
+# Flag in the compression byte of a section header: the section holds zoomed out level n of the map (see MapPyramid),
+# named 'level' + n, one tile char per tile compressed like the payload. Chunked and uncompressed maps store every
+# level, so lazily loaded maps of any size can zoom out without reading the whole map
+SECTION_LEVEL = 0x80
+LAYER_SPAWN_DISTANCE = 'spawn_distance'
+LAYER_WALL_DISTANCE = 'wall_distance'
+# Layer value of tiles that can not be reached from the spawn (and walls)
+UNREACHABLE = 0xffffffff
+# Milliseconds the viewer waits for a key before looking around again, -1 waits for as long as it takes
+INPUT_TIMEOUT_MS = -1
+# How often the viewer checks on background jobs while any are running
+BACKGROUND_POLL_MS = 100
+# Handle every key waiting in the input buffer before drawing, so held down keys never lag behind
+COALESCE_KEYS = True
+# Most times a second progress is redrawn, and the stage labels shown by each curses loading screen
+PROGRESS_FPS = 10
+GEN_STAGES = (('regions', 'Generating V-Regions'), ('voronoi', 'Converting tiles -> V-Regions'))
+CONNECT_STAGES = (('connect', 'Connecting regions to spawn'),)
+FIELD_STAGES = (('fields', 'Computing distance fields'),)
+SAVE_STAGES = (('convert', 'Converting objects to file format'), ('write', 'Compressing and writing'))
+LOAD_STAGES = (('read', 'Decompressing and loading'), ('convert', 'Converting data to game objects'))
+# Runs of wall tiles or of other tiles in a row of the map, each run is drawn with one addstr
+ROW_RUNS = re.compile(re.escape(WALLCH.encode('ascii')) + b'+|[^' + re.escape(WALLCH.encode('ascii')) + b']+')
+FLOOR_RUNS = re.compile(b'[^' + re.escape(WALLCH.encode('ascii')) + b']+')
+# Names of the compressions for the command line
+COMPRESSIONS = {'none': COMPRESS_NONE, 'zlib': COMPRESS_ZLIB, 'chunked': COMPRESS_CHUNKED}
+MAP_ZLIB_LEVEL = 6
+# Chunked payload (COMPRESS_CHUNKED): chunk size, an index of (offset, length) per chunk in row major order with
+# offsets relative to the data after the index, then every chunk zlib compressed on its own
+CHUNK_HEADER = struct.Struct('<I')
+CHUNK_INDEX = struct.Struct('<QI')
+MAP_CHUNK_SIZE = 64
+# Memory budget for decompressed chunks of chunked maps
+CHUNK_CACHE_BYTES = 64 << 20
+# Range of voronoi regions in each chunk of an endless (streamed) map
+STREAM_REGIONS = (4, 12)
+# Legacy json maps are gzip files
+GZIP_MAGIC = b'\x1f\x8b'
+# Json maps are written and parsed this many chars (or tiles) at a time
+JSON_CHUNK = 1 << 20
+JSON_TILES = 4096
+JSON_SPACE = re.compile(r'[ \t\n\r]*')
+# Instrumentation: a chrome trace of named spans is written to the file named by MAPS_TRACE (or maps.py --trace),
+# and MAPS_PROFILE (or --profile) saves a cProfile of the next map generation
+TRACE_ENV = 'MAPS_TRACE'
+PROFILE_ENV = 'MAPS_PROFILE'
+# Map exports, by file extension. PNG maps have one pixel per tile in the colours of the curses viewer (wall,
+# floor, anything else), and are compressed EXPORT_ROWS rows at a time
+EXPORT_FORMATS = {'.html': 'html', '.htm': 'html', '.txt': 'text', '.png': 'png'}
+EXPORT_ROWS = 256
+# Zoomed out levels of a map are built PYRAMID_ROWS rows at a time, a tile of level n + 1 is floor when at least
+# half of the 2x2 tiles of level n under it are not walls (so one tile wide corridors stay visible)
+PYRAMID_ROWS = 256
+PYRAMID_FLOOR = bytes(0 if c == ord(WALLCH) else 1 for c in range(0, 256))
+# Maps loaded lazily (chunked or memory mapped) with more tiles than this and no levels stored in the file get no
+# pyramid, building one would read the whole file and keep a quarter of the map in memory
+PYRAMID_LAZY_CELLS = 1 << 22
+# Whole map overview next to the stats window, at the most detailed level that fits in it
+MINIMAP_HEIGHT = 12
+MINIMAP_WIDTH = 24
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+PNG_PALETTE = bytes((0x5f, 0x00, 0xff, 0x5f, 0x5f, 0x87, 0x00, 0xaf, 0x5f))
+# Tile char -> palette index, 0 (the png row filter byte) maps to itself
+PNG_TABLE = bytes(0 if c == 0 or c == ord(WALLCH) else 1 if c == ord(FLOORCH) else 2 for c in range(0, 256))
+HTML_HEAD = ('<!DOCTYPE html>\n<html>\n<head>\n<style>body{font-family: monospace; font-size: 10px;}</style>\n'
+             '</head>\n<body>\n<pre>\n')
+HTML_TAIL = '</pre>\n</body>\n</html>\n'
+
+# Bits of a neighbor mask, set when the adjacent tile in that direction is in bounds and not a wall
+NEIGHBOR_UP = 1
+NEIGHBOR_DOWN = 2
+NEIGHBOR_LEFT = 4
+NEIGHBOR_RIGHT = 8
+NEIGHBOR_OFFSETS = ((-1, 0, NEIGHBOR_UP), (1, 0, NEIGHBOR_DOWN), (0, -1, NEIGHBOR_LEFT), (0, 1, NEIGHBOR_RIGHT))
 
 # Object used for each tile on the screen. Used to store data relating to tiles
 # such as the tile type, adjacent tile positions, or costs for pathfinding
@@ -29,17 +161,6 @@ class Tile:
         self.ch = c
         self.neighbors = list()
 
-    def update_neighbors(self, game_objects):
-        self.neighbors = list()
-        possible_neighbors = {(self.y+1,self.x), (self.y-1,self.x), (self.y,self.x+1), (self.y,self.x-1)}
-        for y,x in possible_neighbors:
-            try:
-                key = get_yx_key(y,x)
-                if game_objects[key]:
-                    self.neighbors.append(key)
-            except KeyError:
-                pass
-
 # Shortcut to make wall tile object
 def add_wall(y, x):
     a = Tile(y, x, WALLCH)
@@ -73,183 +194,1581 @@ def get_yx_key(y,x):
 def get_tile_key(tile):
     return str(tile.y)+"x"+ str(tile.x)
 
-# Creates a new map using voronoi regions, currently slow: 20 seconds for 100x100, 5-10 min for 300x300
-def gen_map(sizey, sizex, midy, midx):
-    # Timer for map generation
-    t = time.process_time()
-    totaltime = 0.0
+# Compact map storage, one byte per tile (the tile char) in a bytearray indexed by y * sizex + x.
+# cells can be any writable buffer of bytes, eg a memoryview of a memory mapped map file.
+# grid[y, x] reads or writes the char of a tile. The grid also acts like the old game_objects dict of tiles:
+# grid['12x34'] builds a Tile for that position and grid['mapsize'] or grid['player'] give the map file dicts
+class Grid(Mapping):
+    def __init__(self, sizey, sizex, cells=None, player=None, seed=None):
+        self.sizey = sizey
+        self.sizex = sizex
+        # Random seed the map was generated from, None when unknown
+        self.seed = seed
+        if cells is None:
+            cells = bytearray(WALLCH.encode('ascii')) * (sizey * sizex)
+        self.cells = cells
+        # Map files have always stored the map size as the player position
+        if player is None:
+            player = (sizey, sizex)
+        self.player = player
+        # Floor region statistics from connect_map, None when that stage did not run
+        self.region_stats = None
+        # Extra per tile values by layer name (eg LAYER_SPAWN_DISTANCE), each indexed by y * sizex + x
+        self.layers = dict()
+        # Zoomed out levels stored in the map file by level number (see SECTION_LEVEL), empty when MapPyramid has
+        # to build them
+        self.levels = dict()
+
+    def in_bounds(self, y, x):
+        return 0 <= y < self.sizey and 0 <= x < self.sizex
+
+    # Raw cell value (the tile char as a byte) at y, x
+    def byte(self, y, x):
+        return self.cells[y * self.sizex + x]
+
+    def row(self, y, x0=0, x1=None):
+        if x1 is None:
+            x1 = self.sizex
+        start = y * self.sizex
+        return bytes(self.cells[start+x0:start+x1])
+
+    # Every tile char row by row as bytes, the payload of a v2 map file
+    def tobytes(self):
+        return bytes(self.cells)
+
+    # Value of a layer at y, x
+    def layer(self, name, y, x):
+        return self.layers[name][y * self.sizex + x]
+
+    # Adjacent tiles that can be walked to, computed from the cells so nothing is stored per tile
+    def neighbors(self, y, x):
+        wall = ord(WALLCH)
+        for dy, dx, bit in NEIGHBOR_OFFSETS:
+            ny = y + dy
+            nx = x + dx
+            if 0 <= ny < self.sizey and 0 <= nx < self.sizex and self.byte(ny, nx) != wall:
+                yield ny, nx
+
+    # One NEIGHBOR_* bitmask per tile (same layout as cells) for every tile at once, for pathfinding
+    def neighbor_mask(self):
+        if np is None:
+            return self._neighbor_mask_python()
+        floor = np.frombuffer(self.cells, dtype=np.uint8).reshape(self.sizey, self.sizex) != ord(WALLCH)
+        mask = np.zeros((self.sizey, self.sizex), dtype=np.uint8)
+        mask[1:, :] |= floor[:-1, :] * np.uint8(NEIGHBOR_UP)
+        mask[:-1, :] |= floor[1:, :] * np.uint8(NEIGHBOR_DOWN)
+        mask[:, 1:] |= floor[:, :-1] * np.uint8(NEIGHBOR_LEFT)
+        mask[:, :-1] |= floor[:, 1:] * np.uint8(NEIGHBOR_RIGHT)
+        return bytearray(mask.tobytes())
+
+    # Rows as big numbers with one byte per tile (1 for floor), the shifted and scaled rows add up to the mask bytes
+    # without ever carrying into the next byte
+    def _neighbor_mask_python(self):
+        table = bytes(0 if c == ord(WALLCH) else 1 for c in range(0, 256))
+        full = (1 << (8 * self.sizex)) - 1
+        rows = [int.from_bytes(self.row(y).translate(table), 'little') for y in range(0, self.sizey)]
+        mask = bytearray()
+        for y in range(0, self.sizey):
+            bits = ((rows[y] << 8) & full) * NEIGHBOR_LEFT + (rows[y] >> 8) * NEIGHBOR_RIGHT
+            if y > 0:
+                bits += rows[y-1] * NEIGHBOR_UP
+            if y + 1 < self.sizey:
+                bits += rows[y+1] * NEIGHBOR_DOWN
+            mask += bits.to_bytes(self.sizex, 'little')
+        return mask
+
+    # Keys of every in bounds adjacent tile, walls included, as stored in the neighbors lists of map files.
+    # The set iteration order is what the old Tile.update_neighbors used, keeping saved files byte identical
+    def neighbor_keys(self, y, x):
+        keys = list()
+        for ny,nx in {(y+1,x), (y-1,x), (y,x+1), (y,x-1)}:
+            if self.in_bounds(ny, nx):
+                keys.append(get_yx_key(ny,nx))
+        return keys
+
+    # Same key order as the dict built by the original gen_map and stored in map files
+    def __iter__(self):
+        yield 'mapsize'
+        yield 'player'
+        for x in range(0, self.sizex):
+            for y in range(0, self.sizey):
+                yield get_yx_key(y,x)
+
+    def __len__(self):
+        return self.sizey * self.sizex + 2
+
+    # A grid is never empty, not even an endless one that has no length
+    def __bool__(self):
+        return True
+
+    def _parse_key(self, key):
+        if isinstance(key, tuple):
+            y, x = key
+        else:
+            try:
+                y, x = (int(n) for n in key.split('x'))
+            except ValueError:
+                raise KeyError(key)
+        if not self.in_bounds(y, x):
+            raise KeyError(key)
+        return y, x
+
+    def __getitem__(self, key):
+        if key == 'mapsize':
+            return {'y': self.sizey, 'x': self.sizex, 'c': '$', 'neighbors': []}
+        if key == 'player':
+            return {'y': self.player[0], 'x': self.player[1], 'c': 'P', 'neighbors': []}
+        y, x = self._parse_key(key)
+        ch = chr(self.byte(y, x))
+        if isinstance(key, tuple):
+            return ch
+        tile = Tile(y, x, ch)
+        tile.neighbors = self.neighbor_keys(y, x)
+        return tile
+
+    def __setitem__(self, key, value):
+        y, x = self._parse_key(key)
+        if isinstance(value, Tile):
+            value = value.ch
+        self.cells[y * self.sizex + x] = ord(value)
+
+# Least recently used cache of decompressed map chunks, limited to max_bytes of chunk data
+class ChunkCache:
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = CHUNK_CACHE_BYTES
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.chunks = OrderedDict()
+
+    # Return the chunk stored under key, calling load(key) to create it on a miss
+    def get(self, key, load):
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return chunk
+        self.misses += 1
+        chunk = load(key)
+        self.chunks[key] = chunk
+        self.size += len(chunk)
+        # Always keep the newest chunk, even if it is bigger than the whole budget
+        while self.size > self.max_bytes and len(self.chunks) > 1:
+            old_key, old = self.chunks.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+        return chunk
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+
+# Read only grid made of chunk x chunk squares that are loaded on first use and kept in a ChunkCache, so moving
+# around a huge map only ever holds the chunks near the player in memory. Subclasses provide _load_chunk(key).
+# Each tile takes cell bytes of a chunk, row and tobytes return cell bytes per tile
+class ChunkedGrid(Grid):
+    def __init__(self, sizey, sizex, chunk, player, seed, cache=None, cell=1):
+        Grid.__init__(self, sizey, sizex, cells=b'', player=player, seed=seed)
+        self.chunk = chunk
+        self.cache = cache if cache is not None else ChunkCache()
+        self.cell = cell
+
+    def close(self):
+        self.cache.clear()
+
+    def _chunk_width(self, cx):
+        return min(self.chunk, self.sizex - cx * self.chunk)
+
+    # Chunk bytes and its width, rows of a chunk are stored one after another
+    def _chunk_at(self, cy, cx):
+        return self.cache.get((id(self), cy, cx), self._load_chunk), self._chunk_width(cx)
+
+    def byte(self, y, x):
+        cy, iy = divmod(y, self.chunk)
+        cx, ix = divmod(x, self.chunk)
+        data, width = self._chunk_at(cy, cx)
+        return data[iy * width + ix]
+
+    def row(self, y, x0=0, x1=None):
+        if x1 is None:
+            x1 = self.sizex
+        cy, iy = divmod(y, self.chunk)
+        cell = self.cell
+        parts = []
+        x = x0
+        while x < x1:
+            cx, ix = divmod(x, self.chunk)
+            data, width = self._chunk_at(cy, cx)
+            end = min(width, ix + x1 - x)
+            parts.append(data[(iy * width + ix) * cell:(iy * width + end) * cell])
+            x += end - ix
+        return b''.join(parts)
+
+    # Loads each chunk once, holding on to a full row of chunks so the cache can not evict them mid row
+    def tobytes(self):
+        cell = self.cell
+        rows = []
+        for cy in range(0, -(-self.sizey // self.chunk)):
+            chunks = [self._chunk_at(cy, cx) for cx in range(0, -(-self.sizex // self.chunk))]
+            for iy in range(0, min(self.chunk, self.sizey - cy * self.chunk)):
+                rows.extend(data[iy * width * cell:(iy + 1) * width * cell] for data, width in chunks)
+        return b''.join(rows)
+
+    def neighbor_mask(self):
+        return Grid(self.sizey, self.sizex, bytearray(self.tobytes())).neighbor_mask()
+
+    def __setitem__(self, key, value):
+        raise TypeError('chunked maps are read only')
+
+# Chunked grid over a COMPRESS_CHUNKED v2 map file, chunks are decompressed from the file as they are needed
+class ChunkFileGrid(ChunkedGrid):
+    def __init__(self, path, fin, offset, sizey, sizex, player, seed, cache=None, cell=1):
+        fin.seek(offset)
+        chunk, = CHUNK_HEADER.unpack(fin.read(CHUNK_HEADER.size))
+        ChunkedGrid.__init__(self, sizey, sizex, chunk, player, seed, cache, cell)
+        self.path = path
+        self.fin = fin
+        self.chunksy = -(-sizey // chunk)
+        self.chunksx = -(-sizex // chunk)
+        count = self.chunksy * self.chunksx
+        table = fin.read(CHUNK_INDEX.size * count)
+        if len(table) < CHUNK_INDEX.size * count:
+            raise ValueError('truncated map file: ' + path)
+        data = offset + CHUNK_HEADER.size + len(table)
+        self.index = [(data + o, n) for o, n in CHUNK_INDEX.iter_unpack(table)]
+
+    def close(self):
+        self.fin.close()
+        ChunkedGrid.close(self)
+
+    def _load_chunk(self, key):
+        cy, cx = key[1:]
+        offset, length = self.index[cy * self.chunksx + cx]
+        self.fin.seek(offset)
+        return zlib.decompress(self.fin.read(length))
+
+# Values of a chunked layer (see LAYER_HEADER), indexed by y * sizex + x like an array('I'). Chunks are read from the
+# map file on first use and share the ChunkCache of the map
+class ChunkFileLayer(Sequence):
+    def __init__(self, path, fin, offset, sizey, sizex, cache=None):
+        self.chunks = ChunkFileGrid(path, fin, offset, sizey, sizex, None, None, cache, cell=4)
+
+    def __len__(self):
+        return self.chunks.sizey * self.chunks.sizex
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        y, x = divmod(i, self.chunks.sizex)
+        return int.from_bytes(self.chunks.row(y, x, x + 1), 'little')
+
+    def __iter__(self):
+        for y in range(0, self.chunks.sizey):
+            yield from _layer_values(self.chunks.row(y))
+
+    # Every value as an array('I'), decompressing each chunk once
+    def toarray(self):
+        return _layer_values(self.chunks.tobytes())
+
+# Endless map generated a chunk at a time as the player gets close to it. Each chunk gets its own voronoi regions
+# from a random.Random seeded with the world seed and the chunk position, so any chunk can be built on its own and
+# always comes out the same. A chunk holds at least one region, so the closest region of a tile is never further
+# than 2 * (chunk - 1) away and looking at the regions of the 5x5 chunks around it gives the exact voronoi map,
+# without seams between chunks. There is no map edge, coordinates can also be negative
+class StreamGrid(ChunkedGrid):
+    def __init__(self, seed, spawny, spawnx, chunk=None, cache=None):
+        ChunkedGrid.__init__(self, None, None, chunk or MAP_CHUNK_SIZE, (spawny, spawnx), seed, cache)
+        self.regions = dict()
+
+    def in_bounds(self, y, x):
+        return True
+
+    # Voronoi regions (y, x, char) of one chunk, the chunk with the spawn position also gets a floor region there
+    def chunk_regions(self, cy, cx):
+        key = (cy, cx)
+        if key not in self.regions:
+            rng = random.Random(str(self.seed) + ':' + str(cy) + ':' + str(cx))
+            regions = []
+            for i in range(0, rng.randrange(STREAM_REGIONS[0], STREAM_REGIONS[1])):
+                rand_y = cy * self.chunk + rng.randrange(0, self.chunk)
+                rand_x = cx * self.chunk + rng.randrange(0, self.chunk)
+                regions.append((rand_y, rand_x, FLOORCH if rng.randrange(0,2) == 1 else WALLCH))
+            if (self.player[0] // self.chunk, self.player[1] // self.chunk) == key:
+                regions.append((self.player[0], self.player[1], FLOORCH)) # player spawn position must be floor
+            self.regions[key] = regions
+        return self.regions[key]
+
+    def _load_chunk(self, key):
+        cy, cx = key[1:]
+        regions = []
+        chars = bytearray()
+        # Same region order for every chunk, so ties between regions are settled the same way everywhere
+        for ny in range(cy-2, cy+3):
+            for nx in range(cx-2, cx+3):
+                for ry, rx, ch in self.chunk_regions(ny, nx):
+                    regions.append((ry, rx))
+                    chars.append(ord(ch))
+        y0 = cy * self.chunk
+        x0 = cx * self.chunk
+        return voronoi_rect(regions, chars, y0, y0 + self.chunk, x0, x0 + self.chunk)
+
+    def _chunk_width(self, cx):
+        return self.chunk
+
+    def tobytes(self):
+        raise TypeError('streamed maps have no end')
+
+    def neighbor_mask(self):
+        raise TypeError('streamed maps have no end')
+
+    def __iter__(self):
+        raise TypeError('streamed maps have no end')
+
+    def __len__(self):
+        raise TypeError('streamed maps have no end')
+
+# Level of detail pyramid of a map for zoomed out views: level 0 is the map itself and every level after it is half
+# as high and wide as the one before, down to a single tile. Levels are built the first time they are asked for and
+# then kept, so drawing any level costs the same as drawing the map at 1:1. See map_pyramid for the maps that get one
+class MapPyramid:
+    def __init__(self, game_objects):
+        self.levels = [game_objects]
+
+    # Number of levels, the last one is 1x1
+    def depth(self):
+        size = max(self.levels[0].sizey, self.levels[0].sizex)
+        depth = 1
+        while size > 1:
+            size = -(-size // 2)
+            depth += 1
+        return depth
+
+    def level(self, n):
+        while len(self.levels) <= n:
+            stored = self.levels[0].levels.get(len(self.levels))
+            self.levels.append(stored if stored is not None else downsample_map(self.levels[-1]))
+        return self.levels[n]
+
+    # Size of level n, without building it
+    def level_size(self, n):
+        sizey = self.levels[0].sizey
+        sizex = self.levels[0].sizex
+        for i in range(0, n):
+            sizey = -(-sizey // 2)
+            sizex = -(-sizex // 2)
+        return sizey, sizex
+
+    # Most detailed level no bigger than height x width
+    def fit(self, height, width):
+        n = 0
+        sizey, sizex = self.level_size(0)
+        while (sizey > height or sizex > width) and n < self.depth() - 1:
+            n += 1
+            sizey, sizex = self.level_size(n)
+        return n
+
+# Pyramid for viewing game_objects zoomed out, None for endless maps and for lazily loaded maps of more than
+# PYRAMID_LAZY_CELLS tiles that have no levels stored in their file
+def map_pyramid(game_objects):
+    if game_objects.sizey is None:
+        return None
+    if (is_lazy_map(game_objects) and game_objects.sizey * game_objects.sizex > PYRAMID_LAZY_CELLS
+            and not game_objects.levels):
+        return None
+    return MapPyramid(game_objects)
+
+# True when the tiles of a map are read from its file as they are used (read_map with lazy) instead of held in memory
+def is_lazy_map(game_objects):
+    return isinstance(game_objects, ChunkedGrid) or not isinstance(game_objects.cells, bytearray)
+
+# Half size copy of a map, each tile is FLOORCH or WALLCH by majority of the 2x2 tiles under it (ties are floor).
+# An odd last row or column is counted twice. Works on any bounded grid, chunked maps are read a band at a time
+def downsample_map(game_objects):
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    outy = -(-sizey // 2)
+    outx = -(-sizex // 2)
+    cells = bytearray()
+    for y0 in range(0, sizey, PYRAMID_ROWS):
+        y1 = min(y0 + PYRAMID_ROWS, sizey)
+        rows = [game_objects.row(y) for y in range(y0, y1)]
+        if np is None:
+            cells += _downsample_rows_python(rows, outx)
+        else:
+            cells += _downsample_rows(rows, sizex)
+    return Grid(outy, outx, cells, seed=game_objects.seed)
+
+# Downsample a band of rows (an even number of them, except at the bottom of the map) in one numpy pass
+def _downsample_rows(rows, sizex):
+    floor = np.frombuffer(b''.join(rows).translate(PYRAMID_FLOOR), dtype=np.uint8).reshape(len(rows), sizex)
+    if len(rows) % 2:
+        floor = np.vstack((floor, floor[-1:]))
+    if sizex % 2:
+        floor = np.hstack((floor, floor[:, -1:]))
+    count = floor[0::2, 0::2] + floor[1::2, 0::2] + floor[0::2, 1::2] + floor[1::2, 1::2]
+    return np.where(count >= 2, np.uint8(ord(FLOORCH)), np.uint8(ord(WALLCH))).tobytes()
+
+def _downsample_rows_python(rows, outx):
+    floorch = ord(FLOORCH)
+    wallch = ord(WALLCH)
+    cells = bytearray()
+    for i in range(0, len(rows), 2):
+        top = rows[i].translate(PYRAMID_FLOOR)
+        bottom = rows[i+1].translate(PYRAMID_FLOOR) if i + 1 < len(rows) else top
+        if len(top) % 2:
+            top += top[-1:]
+            bottom += bottom[-1:]
+        cells += bytes(floorch if a + b + c + d >= 2 else wallch
+                       for a, b, c, d in zip(top[0::2], top[1::2], bottom[0::2], bottom[1::2]))
+    return cells
+
+# Label tiles with the char of the closest (manhattan distance) voronoi region, yields (y0, y1, rows) chunks
+# where rows holds the chars of rows y0 to y1 as bytes. Matches the original per tile loop exactly: ties keep the
+# earliest region, a tile that no region beats v_regions[0] on stays a wall, and the map edge is always wall
+def voronoi_rows(sizey, sizex, v_regions):
+    regions, chars = _voronoi_table(v_regions)
+    step = max(1, VORONOI_CHUNK_CELLS // sizex)
+    for y0 in range(0, sizey, step):
+        y1 = min(sizey, y0 + step)
+        yield y0, y1, _voronoi_band(regions, chars, sizey, sizex, y0, y1)
+
+# Fill cells (sizey * sizex bytes) with the voronoi_rows labels, yielding the number of rows done after each band.
+# With workers > 1 the bands are labelled by a pool of processes that write their rows straight into one shared
+# memory block, which is copied into cells once at the end. The result is byte identical to a single process
+def voronoi_fill(cells, sizey, sizex, v_regions, workers=1):
+    if workers <= 1:
+        for y0, y1, rows in voronoi_rows(sizey, sizex, v_regions):
+            cells[y0*sizex:y1*sizex] = rows
+            yield y1 - y0
+        return
+    regions, chars = _voronoi_table(v_regions)
+    # Several bands per worker keeps them all busy until the end, and each band stays within the chunk limit
+    step = max(1, min(VORONOI_CHUNK_CELLS // sizex, -(-sizey // (workers * 4))))
+    shm = shared_memory.SharedMemory(create=True, size=sizey * sizex)
+    try:
+        initargs = (shm.name, regions, chars, sizey, sizex)
+        with ProcessPoolExecutor(workers, initializer=_voronoi_worker_init, initargs=initargs) as pool:
+            bands = [pool.submit(_voronoi_worker, y0, min(sizey, y0 + step)) for y0 in range(0, sizey, step)]
+            for band in as_completed(bands):
+                yield band.result()
+        cells[:] = shm.buf
+    finally:
+        shm.close()
+        shm.unlink()
+
+# Region positions and the region index -> tile char table, region 0 can never win so it maps to wall
+def _voronoi_table(v_regions):
+    regions = [(v.y, v.x) for v in v_regions]
+    chars = bytearray(''.join(v.ch for v in v_regions).encode('ascii'))
+    chars[0] = ord(WALLCH)
+    return regions, bytes(chars)
+
+# Labels of rows y0 to y1 of a sizey x sizex map, with the walls around the end of the map
+def _voronoi_band(regions, chars, sizey, sizex, y0, y1):
+    wall = ord(WALLCH)
+    rows = bytearray(voronoi_rect(regions, chars, y0, y1, 0, sizex))
+    # Make walls around end of map
+    for i in range(0, len(rows), sizex):
+        rows[i] = rows[i+sizex-1] = wall
+    if y0 == 0:
+        rows[:sizex] = bytes([wall]) * sizex
+    if y1 == sizey:
+        rows[-sizex:] = bytes([wall]) * sizex
+    return bytes(rows)
+
+# Shared memory block and regions of a voronoi_fill worker process, sent once when the worker starts
+_voronoi_worker_state = None
+
+def _voronoi_worker_init(name, regions, chars, sizey, sizex):
+    global _voronoi_worker_state
+    _voronoi_worker_state = (shared_memory.SharedMemory(name=name), regions, chars, sizey, sizex)
+
+def _voronoi_worker(y0, y1):
+    shm, regions, chars, sizey, sizex = _voronoi_worker_state
+    shm.buf[y0*sizex:y1*sizex] = _voronoi_band(regions, chars, sizey, sizex, y0, y1)
+    return y1 - y0
+
+# Nearest region for every tile in the rectangle rows y0-y1, columns x0-x1, returned as bytes of chars[index].
+# Manhattan distance is separable, so instead of testing every region per tile each region is clamped onto the
+# rectangle (keeping the distance it had to travel) and then spread with two vertical and two horizontal running
+# minimum passes. Keys are distance * len(regions) + index, so the minimum also picks the earliest region on ties.
+# Cost is O(tiles + regions) per rectangle, regions outside of it are handled exactly
+def voronoi_rect(regions, chars, y0, y1, x0, x1):
+    if np is None:
+        return _voronoi_rect_python(regions, chars, y0, y1, x0, x1)
+    n = len(regions)
+    ry = np.array([r[0] for r in regions], dtype=np.int64)
+    rx = np.array([r[1] for r in regions], dtype=np.int64)
+    cy = np.clip(ry, y0, y1-1)
+    cx = np.clip(rx, x0, x1-1)
+    keys = np.full((y1-y0, x1-x0), np.iinfo(np.int64).max // 2, dtype=np.int64)
+    np.minimum.at(keys, (cy-y0, cx-x0), (np.abs(ry-cy) + np.abs(rx-cx)) * n + np.arange(n))
+    keys = _spread_keys(keys, n)
+    table = np.frombuffer(bytes(chars), dtype=np.uint8)
+    return table[keys % n].tobytes()
+
+# Spread distance * n + index keys over a 2d int64 array, each key growing by n per tile it moves, so every cell
+# ends up with the key of its nearest (manhattan distance) seed
+def _spread_keys(keys, n):
+    h, w = keys.shape
+    # Running minimum of key - position * n spreads each key one step further per tile, downwards then upwards
+    step = np.arange(h, dtype=np.int64)[:, None] * n
+    keys = np.minimum.accumulate(keys - step, axis=0) + step
+    keys = np.minimum.accumulate((keys + step)[::-1], axis=0)[::-1] - step
+    # Same again along the rows, right then left
+    step = np.arange(w, dtype=np.int64)[None, :] * n
+    keys = np.minimum.accumulate(keys - step, axis=1) + step
+    keys = np.minimum.accumulate((keys + step)[:, ::-1], axis=1)[:, ::-1] - step
+    return keys
+
+# Pure python version of voronoi_rect, used when numpy is not installed
+def _voronoi_rect_python(regions, chars, y0, y1, x0, x1):
+    n = len(regions)
+    h = y1 - y0
+    w = x1 - x0
+    keys = [[math.inf] * w for y in range(0, h)]
+    for i, (ry, rx) in enumerate(regions):
+        cy = min(max(ry, y0), y1-1)
+        cx = min(max(rx, x0), x1-1)
+        key = (abs(ry-cy) + abs(rx-cx)) * n + i
+        if key < keys[cy-y0][cx-x0]:
+            keys[cy-y0][cx-x0] = key
+    out = bytearray()
+    for row in _spread_keys_python(keys, n):
+        out += bytes([chars[k % n] for k in row])
+    return bytes(out)
+
+# Pure python version of _spread_keys, keys is a list of rows (lists) with math.inf where there is no seed
+def _spread_keys_python(keys, n):
+    for y in range(1, len(keys)):
+        keys[y] = list(map(min, keys[y], [k + n for k in keys[y-1]]))
+    for y in range(len(keys)-2, -1, -1):
+        keys[y] = list(map(min, keys[y], [k + n for k in keys[y+1]]))
+    for row in keys:
+        for x in range(1, len(row)):
+            if row[x-1] + n < row[x]:
+                row[x] = row[x-1] + n
+        for x in range(len(row)-2, -1, -1):
+            if row[x+1] + n < row[x]:
+                row[x] = row[x+1] + n
+    return keys
+
+# Progress of a long job made of named stages. Hot loops only store counters through update(), drawing is left to
+# sink(progress) which is called at most fps times a second, plus once when a stage completes. With no sink nothing
+# is ever drawn, so a Progress() can always be passed around instead of checking for None
+class Progress:
+    def __init__(self, sink=None, stages=(), fps=None):
+        self.sink = sink
+        # stage name -> [label, done, total], in the order the stages should be shown
+        self.stages = OrderedDict()
+        for name, label in stages:
+            self.stages[name] = [label, 0, 0]
+        self.interval = 1.0 / (fps or PROGRESS_FPS)
+        self.start = time.perf_counter()
+        self.drawn = 0.0
+
+    def update(self, stage, done, total):
+        counts = self.stages.get(stage)
+        if counts is None:
+            counts = self.stages[stage] = [stage, 0, 0]
+        counts[1] = done
+        counts[2] = total
+        if self.sink is not None:
+            now = time.perf_counter()
+            if done >= total or now - self.drawn >= self.interval:
+                self.drawn = now
+                self.sink(self)
+
+    def percent(self, stage):
+        label, done, total = self.stages[stage]
+        return int((done / total) * 100) if total else 0
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+# First free line of a window below what curses_progress draws
+def progress_lines(progress):
+    return len(progress.stages) + 3
+
+# Progress sink drawing each stage on its own line of a curses window, with the total time below them
+def curses_progress(win):
+    def draw(progress):
+        line = 1
+        for name, (label, done, total) in progress.stages.items():
+            win.addstr(line, 1, '[' + label + '] -> ' + str(progress.percent(name)) + '%  ')
+            line += 1
+        win.addstr(line + 1, 1, '[Total Time]:' + str(int(progress.elapsed())))
+        win.border(0)
+        win.refresh()
+    return draw
+
+# Progress sink writing a single self overwriting line to stderr, for the command line
+def stderr_progress(progress):
+    parts = [name + ' ' + str(progress.percent(name)) + '%' for name in progress.stages]
+    sys.stderr.write('\r' + ' '.join(parts) + ' %.1fs' % progress.elapsed())
+    sys.stderr.flush()
+
+# Records spans (name, start, duration) while tracing is on, see span() and start_trace()
+class Tracer:
+    def __init__(self, path, start=None):
+        self.path = path
+        # Worker processes are given the start of the tracer they report to, perf_counter is the same clock in
+        # every process so their events line up with the parent's
+        self.start = time.perf_counter() if start is None else start
+        self.events = []
+
+    def add(self, name, start, end, args):
+        event = {'name': name, 'ph': 'X', 'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(), 'tid': 0}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    # Hand over the events recorded so far, for a worker process to send them back to the parent
+    def take(self):
+        events = self.events
+        self.events = []
+        return events
+
+    # Chrome trace event format, opens in chrome://tracing or https://ui.perfetto.dev
+    def write(self):
+        with open(self.path, 'w') as fout:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fout)
+
+    # Count, total, mean and max time of each span name, slowest total first
+    def summary(self):
+        spans = dict()
+        for event in self.events:
+            times = spans.setdefault(event['name'], [])
+            times.append(event['dur'] / 1000)
+        lines = ['%-24s %8s %12s %10s %10s' % ('span', 'count', 'total ms', 'mean ms', 'max ms')]
+        for name, times in sorted(spans.items(), key=lambda s: -sum(s[1])):
+            lines.append('%-24s %8d %12.1f %10.2f %10.2f' % (name, len(times), sum(times), sum(times) / len(times),
+                                                            max(times)))
+        return '\n'.join(lines) + '\n'
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.tracer.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+# Stands in for every span while tracing is off, so a span costs one function call and nothing is recorded
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+NO_SPAN = _NoSpan()
+# The running Tracer, None when tracing is off
+TRACER = None
+# Where the next generate_map saves its cProfile stats, None for no profiling
+PROFILE_PATH = None
+
+# Time a block of code as a named span of the trace: with span('generate.voronoi'): ...
+def span(name, **args):
+    if TRACER is None:
+        return NO_SPAN
+    return _Span(TRACER, name, args)
+
+def start_trace(path):
+    global TRACER
+    TRACER = Tracer(path)
+
+# Stop tracing, write the trace file and return the summary table
+def stop_trace():
+    global TRACER
+    tracer = TRACER
+    TRACER = None
+    if tracer is None:
+        return ''
+    tracer.write()
+    return tracer.summary()
+
+# Floor regions (4 way connected floor tiles) of a map, joined to the region of the spawn by corridors when carve
+# is set. Returns region statistics (counted before any corridor is dug) and reports the 'connect' stage to progress.
+# Labelling is one pass over the rows: each run of floor in a row is merged (union find) with the runs it touches
+# in the row above. Corridors follow a minimum spanning tree of the regions: every tile gets its nearest floor tile
+# (the voronoi_rect passes with every floor tile as a region), two touching tiles whose nearest floor tiles are in
+# different regions give a corridor between those floor tiles, and the shortest ones that join new regions are dug
+def connect_map(game_objects, spawny, spawnx, carve=True, progress=None):
+    if progress is None:
+        progress = Progress()
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    if carve and game_objects.byte(spawny, spawnx) == ord(WALLCH):
+        game_objects[spawny, spawnx] = FLOORCH
+    runs, labels = _floor_regions(game_objects, progress)
+    count = max(labels) if labels else 0
+    sizes = [0] * (count + 1)
+    spawn = 0
+    for (start, end), label in zip(runs, labels):
+        sizes[label] += end - start
+        if start <= spawny * sizex + spawnx < end:
+            spawn = label
+    floor = sum(sizes)
+    stats = {'floor': floor, 'regions': count, 'largest': max(sizes), 'spawn': sizes[spawn],
+             'unreachable': floor - sizes[spawn], 'corridors': 0, 'carved': 0}
+    if carve and count > 1:
+        stats['corridors'], stats['carved'] = _carve_corridors(game_objects, runs, labels, count)
+    progress.update('connect', sizey + 1, sizey + 1)
+    return stats
+
+# Floor runs of every row as (start, end) cell offsets, and the region number (1, 2, ... in map order) of each run
+def _floor_regions(game_objects, progress):
+    sizex = game_objects.sizex
+    runs = []
+    parents = []
+    above = []
+    for y in range(0, game_objects.sizey):
+        row = []
+        k = 0
+        for m in FLOOR_RUNS.finditer(game_objects.row(y)):
+            x0, x1 = m.span()
+            r = len(runs)
+            runs.append((y * sizex + x0, y * sizex + x1))
+            parents.append(r)
+            row.append((x0, x1, r))
+            # Runs above that end before this one starts can not touch any later run of this row either
+            while k < len(above) and above[k][1] <= x0:
+                k += 1
+            j = k
+            while j < len(above) and above[j][0] < x1:
+                _union_regions(parents, above[j][2], r)
+                j += 1
+        above = row
+        progress.update('connect', y + 1, game_objects.sizey + 1)
+    numbers = dict()
+    labels = []
+    for r in range(0, len(runs)):
+        labels.append(numbers.setdefault(_find_region(parents, r), len(numbers) + 1))
+    return runs, labels
+
+def _find_region(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+# Merge the sets of a and b, the lowest number becomes the root
+def _union_regions(parents, a, b):
+    a = _find_region(parents, a)
+    b = _find_region(parents, b)
+    if a < b:
+        parents[b] = a
+    elif b < a:
+        parents[a] = b
+    return a != b
+
+# Dig the corridors of connect_map, returns the number of corridors and of wall tiles turned to floor
+def _carve_corridors(game_objects, runs, labels, count):
+    sizex = game_objects.sizex
+    wall = ord(WALLCH)
+    edges, tiles = _corridor_edges(game_objects, runs, labels)
+    parents = list(range(0, count + 1))
+    joins = 0
+    corridors = 0
+    carved = 0
+    for cost, a, b, start, end in edges:
+        if joins == count - 1:
+            break
+        if not _union_regions(parents, a, b):
+            continue
+        joins += 1
+        corridors += 1
+        # Straight down (or up) from start, then along to end
+        y0, x0 = divmod(start, sizex)
+        y1, x1 = divmod(end, sizex)
+        path = [(y, x0) for y in range(y0, y1, 1 if y1 > y0 else -1)]
+        path += [(y1, x) for x in range(x0, x1, 1 if x1 > x0 else -1)]
+        for y, x in path:
+            if game_objects.byte(y, x) == wall:
+                game_objects[y, x] = FLOORCH
+                carved += 1
+            elif tiles[y * sizex + x] and _union_regions(parents, a, int(tiles[y * sizex + x])):
+                # The corridor ran into another region on the way, which is now joined as well
+                joins += 1
+    return corridors, carved
+
+# Possible corridors between regions as (length, region a, region b, floor tile in a, floor tile in b), the shortest
+# per pair of regions, sorted shortest first. Also returns the region number of every tile (0 for walls).
+# Each tile is paired with the floor tile closest to it and an edge runs between two touching tiles paired with
+# different regions. Only the labels and the pairing are kept for the whole map, edges are found and narrowed down to
+# the best one per pair of regions VORONOI_CHUNK_CELLS tiles at a time
+def _corridor_edges(game_objects, runs, labels):
+    if np is None:
+        return _corridor_edges_python(game_objects, runs, labels)
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    n = sizey * sizex
+    tiles = np.zeros(n, dtype=np.int32)
+    for (start, end), label in zip(runs, labels):
+        tiles[start:end] = label
+    keys = np.full((sizey, sizex), np.iinfo(np.int64).max // 2, dtype=np.int64)
+    floor = np.flatnonzero(tiles)
+    keys.ravel()[floor] = floor
+    del floor
+    step = max(1, VORONOI_CHUNK_CELLS // sizex)
+    bands = [(y0, min(y0 + step, sizey)) for y0 in range(0, sizey, step)]
+    _spread_keys_banded(keys, n, bands)
+    best = []
+    for y0, y1 in bands:
+        # The band and the row below it, for the edges that cross into the next band
+        band = keys[y0:min(y1 + 1, sizey)]
+        nearest = band % n
+        distance = band // n
+        region = tiles[nearest]
+        for dy, dx in ((0, 1), (1, 0)):
+            rows = y1 - y0 if dx else band.shape[0] - 1
+            ra = region[:rows, :sizex-dx]
+            rb = region[dy:dy+rows, dx:]
+            iy, ix = np.nonzero(ra != rb)
+            p = (iy + y0) * np.int64(sizex) + ix
+            edge = (distance[iy, ix] + distance[iy + dy, ix + dx], ra[iy, ix], rb[iy, ix],
+                    nearest[iy, ix], nearest[iy + dy, ix + dx], p, p + (dy * sizex + dx))
+            best.append(_best_edges(*edge))
+    cost, a, b, start, end, p, q = (np.concatenate(column) for column in zip(*best))
+    cost, a, b, start, end, p, q = _best_edges(cost, a, b, start, end, p, q)
+    edges = zip(cost.tolist(), a.tolist(), b.tolist(), start.tolist(), end.tolist())
+    return list(edges), tiles
+
+# Shortest edge of each pair of regions among candidate edges between touching tiles p and q (regions ra and rb,
+# closest floor tiles sa and sb). Ties are settled by p then q, the result is sorted by length then region pair
+def _best_edges(cost, ra, rb, sa, sb, p, q):
+    swap = ra > rb
+    a = np.where(swap, rb, ra)
+    b = np.where(swap, ra, rb)
+    start = np.where(swap, sb, sa)
+    end = np.where(swap, sa, sb)
+    order = np.lexsort((q, p, b, a, cost))
+    first = np.unique((a.astype(np.int64) << 32 | b)[order], return_index=True)[1]
+    order = order[np.sort(first)]
+    return cost[order], a[order], b[order], start[order], end[order], p[order], q[order]
+
+# _spread_keys over a whole map in place, a band of rows at a time so the temporary arrays stay band sized.
+# The pass down (and then up) the columns carries the last row of each band over to the next one
+def _spread_keys_banded(keys, n, bands):
+    for order in (bands, bands[::-1]):
+        carry = None
+        for y0, y1 in order:
+            band = keys[y0:y1] if order is bands else keys[y0:y1][::-1]
+            if carry is not None:
+                np.minimum(band[0], carry + n, out=band[0])
+            step = np.arange(y1 - y0, dtype=np.int64)[:, None] * n
+            band[:] = np.minimum.accumulate(band - step, axis=0) + step
+            carry = band[-1].copy()
+    step = np.arange(keys.shape[1], dtype=np.int64)[None, :] * n
+    for y0, y1 in bands:
+        band = keys[y0:y1]
+        band[:] = np.minimum.accumulate(band - step, axis=1) + step
+        band[:] = np.minimum.accumulate((band + step)[:, ::-1], axis=1)[:, ::-1] - step
+
+# Pure python version of _corridor_edges, used when numpy is not installed
+def _corridor_edges_python(game_objects, runs, labels):
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    n = sizey * sizex
+    tiles = array('i', bytes(4 * n))
+    for (start, end), label in zip(runs, labels):
+        tiles[start:end] = array('i', [label]) * (end - start)
+    keys = [[y * sizex + x if tiles[y * sizex + x] else math.inf for x in range(0, sizex)] for y in range(0, sizey)]
+    keys = [k for row in _spread_keys_python(keys, n) for k in row]
+    best = dict()
+    for p in range(0, n):
+        for q in (p + 1, p + sizex):
+            if q >= n or (q == p + 1 and q % sizex == 0):
+                continue
+            ra = tiles[keys[p] % n]
+            rb = tiles[keys[q] % n]
+            if ra == rb:
+                continue
+            edge = (keys[p] // n + keys[q] // n, p, q, keys[p] % n, keys[q] % n)
+            if ra > rb:
+                ra, rb = rb, ra
+                edge = edge[:3] + (edge[4], edge[3])
+            if (ra, rb) not in best or edge < best[ra, rb]:
+                best[ra, rb] = edge
+    edges = sorted((cost, a, b, start, end) for (a, b), (cost, p, q, start, end) in best.items())
+    return edges, tiles
+
+# Distance field layers of a map: LAYER_SPAWN_DISTANCE is the number of steps from the spawn to each tile
+# (UNREACHABLE for walls and floor that can't be reached) and LAYER_WALL_DISTANCE the manhattan distance from each
+# tile to the closest wall (0 for walls). Returns them as a dict of layer name -> array('I'), like Grid.layers.
+# Reports the 'fields' stage to progress
+def distance_fields(game_objects, spawny, spawnx, progress=None):
+    if progress is None:
+        progress = Progress()
+    layers = dict()
+    layers[LAYER_SPAWN_DISTANCE] = spawn_distance(game_objects, spawny, spawnx)
+    progress.update('fields', 1, 2)
+    layers[LAYER_WALL_DISTANCE] = wall_distance(game_objects)
+    progress.update('fields', 2, 2)
+    return layers
+
+# Breadth first search over the floor from the spawn. With numpy each step of the search handles the whole
+# frontier at once, over a copy of the map padded with walls so neighbours never wrap around or leave the map
+def spawn_distance(game_objects, spawny, spawnx):
+    if np is None:
+        return _spawn_distance_python(game_objects, spawny, spawnx)
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    width = sizex + 2
+    cells = np.frombuffer(game_objects.tobytes(), dtype=np.uint8).reshape(sizey, sizex)
+    seen = np.ones((sizey + 2, width), dtype=bool)
+    seen[1:-1, 1:-1] = cells == ord(WALLCH)
+    seen = seen.ravel()
+    distance = np.full(seen.size, UNREACHABLE, dtype=np.uint32)
+    frontier = np.array([], dtype=np.int64)
+    if game_objects.in_bounds(spawny, spawnx) and not seen[(spawny + 1) * width + spawnx + 1]:
+        frontier = np.array([(spawny + 1) * width + spawnx + 1], dtype=np.int64)
+        seen[frontier] = True
+    steps = 0
+    while frontier.size:
+        distance[frontier] = steps
+        steps += 1
+        frontier = np.concatenate((frontier - 1, frontier + 1, frontier - width, frontier + width))
+        frontier = np.unique(frontier[~seen[frontier]])
+        seen[frontier] = True
+    return _layer_array(distance.reshape(sizey + 2, width)[1:-1, 1:-1])
+
+# Pure python version of spawn_distance, used when numpy is not installed
+def _spawn_distance_python(game_objects, spawny, spawnx):
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    wall = ord(WALLCH)
+    distance = array('I', [UNREACHABLE]) * (sizey * sizex)
+    if not game_objects.in_bounds(spawny, spawnx) or game_objects.byte(spawny, spawnx) == wall:
+        return distance
+    distance[spawny * sizex + spawnx] = 0
+    frontier = [(spawny, spawnx)]
+    steps = 0
+    while frontier:
+        steps += 1
+        reached = []
+        for y, x in frontier:
+            for ny, nx in game_objects.neighbors(y, x):
+                if distance[ny * sizex + nx] == UNREACHABLE:
+                    distance[ny * sizex + nx] = steps
+                    reached.append((ny, nx))
+        frontier = reached
+    return distance
+
+# Manhattan distance transform to the walls, the _spread_keys passes with every wall tile as a region
+def wall_distance(game_objects):
+    sizey = game_objects.sizey
+    sizex = game_objects.sizex
+    n = sizey * sizex
+    if np is None:
+        wall = ord(WALLCH)
+        keys = [[0 if c == wall else math.inf for c in game_objects.row(y)] for y in range(0, sizey)]
+        keys = _spread_keys_python(keys, 1)
+        return array('I', [UNREACHABLE if k == math.inf else k for row in keys for k in row])
+    big = np.iinfo(np.int64).max // 2
+    cells = np.frombuffer(game_objects.tobytes(), dtype=np.uint8).reshape(sizey, sizex)
+    keys = _spread_keys(np.where(cells == ord(WALLCH), 0, big).astype(np.int64), 1)
+    # A map without a single wall has no distances
+    return _layer_array(np.where(keys >= big // 2, UNREACHABLE, keys))
+
+# numpy array of layer values as an array('I')
+def _layer_array(values):
+    layer = array('I')
+    layer.frombytes(np.ascontiguousarray(values, dtype=np.uint32).tobytes())
+    return layer
+
+# Creates a new map using voronoi regions without any screen output, the voronoi stage runs on numpy when it is
+# installed. With connect (CONNECT_MAP by default) every floor region is then joined to the spawn, see connect_map,
+# and with fields (DISTANCE_FIELDS by default) the distance_fields layers are added to the map.
+# With a seed the map only depends on the seed and the other arguments (not workers), and the same seed always
+# gives the same map for a GENERATOR_VERSION. Without one the shared random module is used.
+# Reports the 'regions', 'voronoi', 'connect' and 'fields' stages to progress. With PROFILE_PATH set this run
+# is profiled and the cProfile stats are saved there, after which profiling is off again
+def generate_map(sizey, sizex, midy, midx, workers=None, progress=None, connect=None, fields=None, seed=None):
+    global PROFILE_PATH
+    if seed is not None:
+        check_seed(seed)
+    args = (sizey, sizex, midy, midx, workers, progress, connect, fields, seed)
+    with span('generate', size=[sizey, sizex], seed=seed):
+        if PROFILE_PATH is None:
+            return _generate_map(*args)
+        path = PROFILE_PATH
+        PROFILE_PATH = None
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(_generate_map, *args)
+        finally:
+            profile.dump_stats(path)
+
+# Raise ValueError unless seed is an int that fits the seed field of a map file, returns the seed
+def check_seed(seed):
+    if not isinstance(seed, int) or isinstance(seed, bool) or not 0 <= seed < SEED_LIMIT:
+        raise ValueError('seed must be an integer from 0 to ' + str(SEED_LIMIT - 1) + ', got ' + repr(seed))
+    return seed
+
+def _generate_map(sizey, sizex, midy, midx, workers, progress, connect, fields, seed):
+    rng = random if seed is None else random.Random(seed)
+    if workers is None:
+        workers = GEN_WORKERS
+    if connect is None:
+        connect = CONNECT_MAP
+    if fields is None:
+        fields = DISTANCE_FIELDS
+    if progress is None:
+        progress = Progress()
+    # Generate a solid grid of walls for each tile position
+    game_objects = Grid(sizey, sizex, seed=seed)
+    # Randomness adds to custom maps, and scales with large or small maps
+    num = int ((sizex + sizey) / 2)
+    regions = rng.randrange(num,num*2)
+    # Pick random spots in grid map to become v regions
+    v_regions = []
+    with span('generate.regions', regions=regions):
+        for i in range(0,regions):
+            rand_y = rng.randrange(0, sizey)
+            rand_x = rng.randrange(0, sizex)
+            rand_type = rng.randrange(0,2)
+            if rand_type == 1:
+                v_regions.append(add_floor(rand_y, rand_x))
+            else:
+                v_regions.append(add_wall(rand_y, rand_x))
+            progress.update('regions', i+1, regions)
+        v_regions.append(add_floor(midy, midx)) # player spawn position must be floor
+    # Convert all game objects to closest voronoi region type (floor or wall), a band of rows at a time
+    done = 0
+    with span('generate.voronoi', workers=workers):
+        for rows in voronoi_fill(game_objects.cells, sizey, sizex, v_regions, workers):
+            done += rows
+            progress.update('voronoi', done, sizey)
+    if connect:
+        with span('generate.connect'):
+            game_objects.region_stats = connect_map(game_objects, midy, midx, progress=progress)
+    if fields:
+        with span('generate.fields'):
+            game_objects.layers.update(distance_fields(game_objects, midy, midx, progress))
+    return game_objects
+
+# Progress stages of generate_map with these options
+def generate_stages(connect=None, fields=None):
+    if connect is None:
+        connect = CONNECT_MAP
+    if fields is None:
+        fields = DISTANCE_FIELDS
+    return GEN_STAGES + (CONNECT_STAGES if connect else ()) + (FIELD_STAGES if fields else ())
+
+# Creates a new map using voronoi regions, showing a curses loading screen while generate_map runs
+def gen_map(sizey, sizex, midy, midx, workers=None, connect=None, fields=None, seed=None):
     # Initialize loading screen window
     loadwin = curses.newwin(MAP_HEIGHT, MAP_WIDTH, 0, 0)
     loadwin.clear()
     loadwin.refresh()
-    # Values for loading bars
-    loadvalue = 1
-    loadmax = sizey * sizex
-    # Generate a solid grid of wall game objects for each tile position
-    game_objects = {'mapsize': {'y': sizey,'x': sizex, 'c': '$', 'neighbors': []}, 'player': {'y': sizey,'x': sizex, 'c': 'P', 'neighbors': []}}
-    for x in range(0, sizey):
-        totaltime = time.process_time() - t
-        percent = int((loadvalue / loadmax) * 100)
-        loadwin.addstr(1, 1, '[Generating tiles] -> ' + str(percent) + '%')
-        loadwin.addstr(2, 1, '[Generating V-Regions] -> 0%')
-        loadwin.addstr(3, 1, '[Converting tiles -> V-Regions] -> 0%')
-        loadwin.addstr(4, 1, '[Pathfinding -> link adjacent tiles] -> 0%')
-        loadwin.addstr(5, 1, '[Total Time]:' + str(int(totaltime)))
-        loadwin.border(0)
-        loadwin.refresh()
-        for y in range(0, sizex):
-            tmp = add_wall(y, x)
-            game_objects[get_tile_key(tmp)] = tmp
-            loadvalue += 1
-    # Values for loading bars, randomness adds to custom maps, and scales with large or small maps
-    num = int ((sizex + sizey) / 2)
-    regions = random.randrange(num,num*2)
-    loadvalue = 1
-    loadmax = regions
-    # Pick random spots in grid map to become v regions
-    v_regions = []
-    for i in range(0,regions):
-        totaltime = time.process_time() - t
-        percent = int((loadvalue / loadmax) * 100)
-        loadwin.addstr(1, 1, '[Generating tiles] -> 100%')
-        loadwin.addstr(2, 1, '[Generating V-Regions] -> ' + str(percent) + '%')
-        loadwin.addstr(3, 1, '[Converting tiles -> V-Regions] -> 0%')
-        loadwin.addstr(4, 1, '[Pathfinding -> link adjacent tiles] -> 0%')
-        loadwin.addstr(5, 1, '[Total Time]:' + str(int(totaltime)))
-        loadwin.border(0)
-        loadwin.refresh()
-        rand_y = random.randrange(0, sizey)
-        rand_x = random.randrange(0, sizex)
-        rand_type = random.randrange(0,2)
-        if rand_type == 1:
-            v_regions.append(add_floor(rand_y, rand_x))
-        else:
-            v_regions.append(add_wall(rand_y, rand_x))
-        loadvalue += 1
-    v_regions.append(add_floor(midy, midx)) # player spawn position must be floor
-    # Values for loading bars, randomness adds to custom maps, and scales with large or small maps
-    percent = 1
-    loadvalue = 1
-    loadmax = sizex * sizey * regions
-    # Convert all game obaects to closest voronoi region type (floor or wall)
-    for key in game_objects.keys():
-        if key == "player" or key == "mapsize":
-            continue
-        totaltime = time.process_time() - t
-        closest = v_regions[0]
-        percent = int((loadvalue / loadmax) * 100)
-        loadwin.addstr(1, 1, '[Generating tiles] -> 100%')
-        loadwin.addstr(2, 1, '[Generating V-Regions] -> 100%')
-        loadwin.addstr(3, 1, '[Converting tiles -> V-Regions] -> ' + str(percent) + '%')
-        loadwin.addstr(4, 1, '[Pathfinding -> link adjacent tiles] -> 0%')
-        loadwin.addstr(5, 1, '[Total Time]:' + str(int(totaltime)))
-        loadwin.border(0)
-        loadwin.refresh()
-        y = game_objects[key].y
-        x = game_objects[key].x
-        for v in v_regions:
-            diff = math.sqrt((v.x-x)**2) + math.sqrt((v.y-y)**2)
-            olddiff = math.sqrt((closest.x-x)**2) + math.sqrt((closest.y-y)**2)
-            # Make walls around end of map
-            if y >= sizey-1 or y <= 0 or x >= sizex-1 or x <= 0:
-                game_objects[key].ch = WALLCH
-            elif diff < olddiff:
-                closest = v
-                game_objects[key].ch = closest.ch
-            loadvalue += 1
-    # Values for loading bars
-    percent = 1
-    loadvalue = 1
-    loadmax = sizex * sizey
-    # Initialize tiles to know adjacent tiles neighbors, for pathfinding costing later
-    for key in game_objects.keys():
-        if key == "player" or key == "mapsize":
-            continue
-        totaltime = time.process_time() - t
-        closest = v_regions[0]
-        percent = int((loadvalue / loadmax) * 100)
-        loadwin.addstr(1, 1, '[Generating tiles] -> 100%')
-        loadwin.addstr(2, 1, '[Generating V-Regions] -> 100%')
-        loadwin.addstr(3, 1, '[Converting tiles -> V-Regions] -> 100%')
-        loadwin.addstr(4, 1, '[Pathfinding -> link adjacent tile] -> ' + str(percent) + '%')
-        loadwin.addstr(5, 1, '[Total Time]:' + str(int(totaltime)))
-        loadwin.border(0)
-        loadwin.refresh()
-        # All neighbor updating is moved to the tile objects for reuse later
-        game_objects[key].update_neighbors(game_objects)
-        loadvalue += 1
+    progress = Progress(curses_progress(loadwin), generate_stages(connect, fields))
+    game_objects = generate_map(sizey, sizex, midy, midx, workers, progress, connect, fields, seed)
     del loadwin
     return game_objects
 
-# Save game_objects to a compress json file at path
+# Directory of generated maps named by a hash of everything that decides their content (seed, size, spawn, stages
+# and GENERATOR_VERSION), so asking for the same map twice reads it back instead of generating it again. Files are
+# v2 maps, the least recently used are deleted once the directory holds more than max_bytes of them
+class MapCache:
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or MAP_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else MAP_CACHE_BYTES
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Only seeded maps can be cached, a map from the shared random module can not be asked for again
+    def key(self, seed, sizey, sizex, midy, midx, connect=None, fields=None):
+        check_seed(seed)
+        params = {'version': GENERATOR_VERSION, 'seed': seed, 'size': [sizey, sizex], 'spawn': [midy, midx],
+                  'connect': bool(CONNECT_MAP if connect is None else connect),
+                  'fields': bool(DISTANCE_FIELDS if fields is None else fields)}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def map_path(self, key):
+        return os.path.join(self.path, key + '.map')
+
+    # The map for these generate_map arguments, from the cache or generated (and cached) when it is not there
+    def get(self, seed, sizey, sizex, midy, midx, connect=None, fields=None, workers=None, progress=None):
+        path = self.map_path(self.key(seed, sizey, sizex, midy, midx, connect, fields))
+        if os.path.exists(path):
+            self.hits += 1
+            # The modification time orders the files for eviction
+            os.utime(path)
+            return read_map(path, progress=progress)
+        self.misses += 1
+        game_objects = generate_map(sizey, sizex, midy, midx, workers, progress, connect, fields, seed)
+        os.makedirs(self.path, exist_ok=True)
+        write_map(path, game_objects, 'v2', progress=progress)
+        self.evict(keep=path)
+        return game_objects
+
+    # Delete the least recently used maps until the cache fits in max_bytes, keep is never deleted
+    def evict(self, keep=None):
+        files = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.map'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+            total += stat.st_size
+        files.sort()
+        for mtime, path, size in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            total -= size
+            self.evictions += 1
+
+# Write a map file in the given format, 'v2' (binary) or 'json' (legacy gzip json, readable by maps-rust)
+# The map is written to a temporary file next to path, synced to disk and then renamed over path, so path always
+# holds either the old file or the whole new one, even if the program or the machine stops half way.
+# Reports the 'convert' (json only) and 'write' stages to progress
+def write_map(path, game_objects, fmt=None, compression=None, progress=None):
+    if fmt is None:
+        fmt = MAP_FORMAT
+    if progress is None:
+        progress = Progress()
+    if fmt not in ('json', 'v2'):
+        raise ValueError('unknown map format: ' + str(fmt))
+    temp = temp_map_path(path, os.getpid())
+    with span('save', path=path, format=fmt):
+        try:
+            with open(temp, 'wb') as fout:
+                if fmt == 'json':
+                    _write_json_map(fout, path, game_objects, progress)
+                else:
+                    _write_v2_map(fout, game_objects, MAP_COMPRESSION if compression is None else compression,
+                                  progress)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+# Temporary file write_map uses for path in process pid
+def temp_map_path(path, pid):
+    return path + '.' + str(pid) + '.tmp'
+
+# Read a map file of any format into a Grid, the format is detected from the first bytes of the file.
+# With lazy, uncompressed v2 maps are memory mapped instead of read, so only the rows that are actually
+# looked at get paged in from disk and opening the map takes the same time whatever its size.
+# Reports the 'read' and 'convert' (json only) stages to progress
+def read_map(path, lazy=False, progress=None):
+    if progress is None:
+        progress = Progress()
+    fmt = map_format(path)
+    with span('load', path=path, format=fmt, lazy=lazy):
+        if fmt == 'json':
+            return _read_json_map(path, progress)
+        elif fmt == 'v2':
+            game_objects = _read_v2_map(path, lazy)
+            progress.update('read', 1, 1)
+            progress.update('convert', 1, 1)
+            return game_objects
+    raise ValueError('not a map file: ' + path)
+
+# Detect the format of a map file, returns 'v2', 'json' or None
+def map_format(path):
+    with open(path, 'rb') as fin:
+        magic = fin.read(len(MAP_MAGIC))
+    if magic == MAP_MAGIC:
+        return 'v2'
+    elif magic[:2] == GZIP_MAGIC:
+        return 'json'
+    return None
+
+# Convert a map file between formats, eg legacy json maps to v2 or v2 maps back to json for maps-rust
+def convert_map(src, dst, fmt, compression=None):
+    write_map(dst, read_map(src), fmt, compression)
+
+# The json map is written JSON_TILES tiles at a time straight into the gzip file, the text is the same as
+# json.dumps of the whole {'mapsize', 'player', tiles...} dict but the dict and the string are never built.
+# The gzip header names the file path, not the temporary file fout that write_map renames to it
+def _write_json_map(fout, path, game_objects, progress):
+    loadmax = len(game_objects) - 2
+    loadvalue = 0
+    keys = (key for key in game_objects.keys() if key != "player" and key != "mapsize")
+    with gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=fout) as fout:
+        fout.write(('{"mapsize": ' + json.dumps(game_objects['mapsize']) + ', "player": ' +
+                    json.dumps(game_objects['player'])).encode('utf-8'))
+        while True:
+            with span('save.convert'):
+                parts = [', ' + json.dumps(key) + ': ' + json.dumps(tile_to_json(game_objects[key]))
+                         for key in itertools.islice(keys, JSON_TILES)]
+            if not parts:
+                break
+            # Gzip compresses as it writes
+            with span('save.write'):
+                fout.write(''.join(parts).encode('utf-8'))
+            loadvalue += len(parts)
+            progress.update('convert', loadvalue, loadmax)
+        fout.write(b'}')
+        progress.update('convert', loadvalue, loadmax)
+    progress.update('write', 1, 1)
+
+# Tiles are parsed from the gzip file JSON_CHUNK chars at a time and stored in the grid as they arrive
+def _read_json_map(path, progress):
+    filesize = os.path.getsize(path)
+    player = None
+    loadvalue = 0
+    # Decompressing, parsing and converting happen together a chunk at a time, they are one span
+    with span('load.parse'):
+        size = _json_map_size(path)
+        game_objects = Grid(size['y'], size['x'])
+        with open(path, 'rb') as raw, gzip.GzipFile(fileobj=raw) as fin:
+            for key, value in JsonObjectReader(io.TextIOWrapper(fin, encoding='utf-8')):
+                if key == "mapsize":
+                    continue
+                if key == "player":
+                    player = (value['y'], value['x'])
+                    continue
+                # Convert json object data into tiles and store their chars in the grid
+                tile = json_to_tile(value)
+                game_objects[tile.y, tile.x] = tile.ch
+                loadvalue += 1
+                if loadvalue % JSON_TILES == 0:
+                    progress.update('read', raw.tell(), filesize)
+                    progress.update('convert', loadvalue, game_objects.sizey * game_objects.sizex)
+    if player is not None:
+        game_objects.player = player
+    progress.update('read', 1, 1)
+    progress.update('convert', 1, 1)
+    return game_objects
+
+# The 'mapsize' value of a json map. This repo writes it first, maps-rust writes the keys in any order: then the
+# file is read up to it here and read again from the start by _read_json_map, so tiles that come before it never
+# have to be kept until the grid exists
+def _json_map_size(path):
+    with open(path, 'rb') as raw, gzip.GzipFile(fileobj=raw) as fin:
+        for key, value in JsonObjectReader(io.TextIOWrapper(fin, encoding='utf-8')):
+            if key == "mapsize":
+                return value
+    raise ValueError('json map has no mapsize: ' + path)
+
+# Key, value pairs of the json object at the start of a text file, read chunk chars at a time. Each value is
+# decoded whole by json, so memory use depends on the largest value and not on the size of the file
+class JsonObjectReader:
+    def __init__(self, fin, chunk=None):
+        self.fin = fin
+        self.chunk = chunk or JSON_CHUNK
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+    # Read the next chunk of text onto the end of the buffer, False at the end of the file
+    def _fill(self):
+        data = self.fin.read(self.chunk)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    # Next char after any whitespace, without using it up, '' at the end of the file
+    def _peek(self):
+        while True:
+            self.pos = JSON_SPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if ch == '' or ch not in chars:
+            raise ValueError('bad json map: expected ' + ' or '.join(repr(c) for c in chars) + ', got ' + repr(ch))
+        self.pos += 1
+        return ch
+
+    # Decode the next value, reading more of the file while it is cut off by the end of the buffer
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError('bad json map: key is not a string: ' + repr(key))
+            self._expect(':')
+            yield key, self._value()
+            if self._expect(',}') == '}':
+                return
+
+def _write_v2_map(fout, game_objects, compression, progress):
+    with span('save.compress', compression=compression):
+        if compression == COMPRESS_CHUNKED:
+            payload = _chunked_payload(game_objects.row, game_objects.sizey, game_objects.sizex, MAP_CHUNK_SIZE)
+        elif compression == COMPRESS_ZLIB:
+            payload = zlib.compress(game_objects.tobytes(), MAP_ZLIB_LEVEL)
+        elif compression == COMPRESS_NONE:
+            payload = game_objects.tobytes()
+        else:
+            raise ValueError('unknown map compression: ' + str(compression))
+    progress.update('convert', 1, 1)
+    seed = game_objects.seed
+    flags = 0 if seed is None else MAP_SEEDED
+    header = MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, compression | flags, game_objects.sizey, game_objects.sizex,
+                             game_objects.player[0], game_objects.player[1], seed or 0, len(payload))
+    with span('save.write'):
+        fout.write(header)
+        fout.write(payload)
+        for name, values in game_objects.layers.items():
+            _write_layer(fout, name, values, compression, game_objects.sizey, game_objects.sizex)
+    # Zlib maps are always read whole, their levels are quicker to build from memory than to store
+    if compression != COMPRESS_ZLIB:
+        with span('save.levels'):
+            pyramid = MapPyramid(game_objects)
+            for n in range(1, pyramid.depth()):
+                _write_level(fout, n, pyramid.level(n), compression)
+    progress.update('write', 1, 1)
+
+def _write_level(fout, n, level, compression):
+    if compression == COMPRESS_CHUNKED:
+        data = _chunked_payload(level.row, level.sizey, level.sizex, MAP_CHUNK_SIZE)
+    else:
+        data = level.tobytes()
+    fout.write(LAYER_HEADER.pack(('level' + str(n)).encode('ascii'), compression | SECTION_LEVEL, len(data)))
+    fout.write(data)
+
+def _write_layer(fout, name, values, compression, sizey, sizex):
+    if isinstance(values, ChunkFileLayer):
+        data = values.toarray()
+    else:
+        data = array('I', values)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    data = data.tobytes()
+    if compression == COMPRESS_CHUNKED:
+        data = _chunked_payload(lambda y, x0, x1: data[(y * sizex + x0) * 4:(y * sizex + x1) * 4],
+                                sizey, sizex, MAP_CHUNK_SIZE)
+    elif compression == COMPRESS_ZLIB:
+        data = zlib.compress(data, MAP_ZLIB_LEVEL)
+    fout.write(LAYER_HEADER.pack(name.encode('ascii'), compression, len(data)))
+    fout.write(data)
+
+# Little endian uint32 layer data as an array('I')
+def _layer_values(data):
+    values = array('I')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+# Layers stored from offset to the end of buf (bytes or a memoryview of the map file), as a dict of name -> values.
+# Uncompressed layers in a memoryview are used in place, so a memory mapped map also maps its layers. Stored levels
+# are added to the levels dict as grids, or skipped when levels is None
+def _read_layers(buf, offset, sizey, sizex, path, levels=None):
+    layers = dict()
+    while offset < len(buf):
+        if len(buf) - offset < LAYER_HEADER.size:
+            raise ValueError('truncated map file: ' + path)
+        name, compression, length = LAYER_HEADER.unpack_from(buf, offset)
+        offset += LAYER_HEADER.size
+        data = buf[offset:offset+length]
+        if len(data) < length:
+            raise ValueError('truncated map file: ' + path)
+        offset += length
+        if compression & SECTION_LEVEL:
+            if levels is not None:
+                n = _level_number(name, path)
+                levels[n] = _read_level(data, n, compression & ~SECTION_LEVEL, sizey, sizex, path)
+            continue
+        if compression == COMPRESS_CHUNKED:
+            data = ChunkFileLayer(path, io.BytesIO(data), 0, sizey, sizex, ChunkCache()).chunks.tobytes()
+        elif compression == COMPRESS_ZLIB:
+            data = zlib.decompress(data)
+        elif compression != COMPRESS_NONE:
+            raise ValueError('unknown layer compression ' + str(compression) + ': ' + path)
+        if len(data) != sizey * sizex * 4:
+            raise ValueError('layer size does not match header: ' + path)
+        if isinstance(data, memoryview) and sys.byteorder == 'little':
+            values = data.cast('I')
+        else:
+            values = _layer_values(data)
+        layers[name.rstrip(b'\0').decode('ascii')] = values
+    return layers
+
+# Number of the level stored in a section named 'level' + n
+def _level_number(name, path):
+    name = name.rstrip(b'\0')
+    if not name.startswith(b'level') or not name[5:].isdigit() or int(name[5:]) < 1:
+        raise ValueError('bad level section ' + repr(name) + ': ' + path)
+    return int(name[5:])
+
+# Level n of a sizey x sizex map from its section data, uncompressed levels in a memoryview are used in place
+def _read_level(data, n, compression, sizey, sizex, path):
+    sizey = -(-sizey // (1 << n))
+    sizex = -(-sizex // (1 << n))
+    if compression == COMPRESS_CHUNKED:
+        data = ChunkFileGrid(path, io.BytesIO(data), 0, sizey, sizex, None, None).tobytes()
+    elif compression != COMPRESS_NONE:
+        raise ValueError('unknown level compression ' + str(compression) + ': ' + path)
+    if len(data) != sizey * sizex:
+        raise ValueError('level size does not match header: ' + path)
+    return Grid(sizey, sizex, data if isinstance(data, memoryview) else bytearray(data))
+
+# Layers of a lazily loaded chunked map from offset to the end of the file, chunked layers and levels are read as
+# they are used through the cache of the map, older zlib layers are decompressed right away
+def _read_chunk_layers(fin, offset, sizey, sizex, path, cache, levels):
+    layers = dict()
+    end = os.fstat(fin.fileno()).st_size
+    while offset < end:
+        fin.seek(offset)
+        header = fin.read(LAYER_HEADER.size)
+        if len(header) < LAYER_HEADER.size:
+            raise ValueError('truncated map file: ' + path)
+        name, compression, length = LAYER_HEADER.unpack(header)
+        offset += LAYER_HEADER.size
+        if offset + length > end:
+            raise ValueError('truncated map file: ' + path)
+        if compression == COMPRESS_CHUNKED | SECTION_LEVEL:
+            n = _level_number(name, path)
+            levels[n] = ChunkFileGrid(path, fin, offset, -(-sizey // (1 << n)), -(-sizex // (1 << n)), None, None,
+                                      cache)
+        elif compression == COMPRESS_CHUNKED:
+            layers[name.rstrip(b'\0').decode('ascii')] = ChunkFileLayer(path, fin, offset, sizey, sizex, cache)
+        else:
+            layers.update(_read_layers(header + fin.read(length), 0, sizey, sizex, path, levels))
+        offset += length
+    return layers
+
+# Split a map (or a layer) into chunk x chunk squares (smaller at the right and bottom edges) and compress each one,
+# row(y, x0, x1) returns the bytes of tiles x0 to x1 of row y
+def _chunked_payload(row, sizey, sizex, chunk):
+    index = []
+    data = []
+    offset = 0
+    for y0 in range(0, sizey, chunk):
+        y1 = min(sizey, y0 + chunk)
+        for x0 in range(0, sizex, chunk):
+            x1 = min(sizex, x0 + chunk)
+            part = zlib.compress(b''.join(row(y, x0, x1) for y in range(y0, y1)), MAP_ZLIB_LEVEL)
+            index.append(CHUNK_INDEX.pack(offset, len(part)))
+            data.append(part)
+            offset += len(part)
+    return CHUNK_HEADER.pack(chunk) + b''.join(index) + b''.join(data)
+
+def _read_v2_map(path, lazy=False):
+    fin = open(path, 'rb')
+    try:
+        header = fin.read(MAP_HEADER.size)
+        if len(header) < MAP_HEADER.size:
+            raise ValueError('truncated map file: ' + path)
+        magic, version, compression, sizey, sizex, playery, playerx, seed, length = MAP_HEADER.unpack(header)
+        if version != MAP_VERSION:
+            raise ValueError('unsupported map version ' + str(version) + ': ' + path)
+        flags = compression & ~0xff
+        compression &= 0xff
+        if not flags & MAP_SEEDED and seed == 0:
+            seed = None
+        if lazy and compression == COMPRESS_CHUNKED:
+            # The chunked grid keeps the file open and reads chunks (of the map and its layers) as they are needed
+            chunks = ChunkFileGrid(path, fin, MAP_HEADER.size, sizey, sizex, (playery, playerx), seed)
+            chunks.layers = _read_chunk_layers(fin, MAP_HEADER.size + length, sizey, sizex, path, chunks.cache,
+                                               chunks.levels)
+            fin = None
+            return chunks
+        if lazy and compression == COMPRESS_NONE and length == sizey * sizex:
+            if os.fstat(fin.fileno()).st_size < MAP_HEADER.size + length:
+                raise ValueError('truncated map file: ' + path)
+            # Copy on write mapping, the grid can still be changed in memory without touching the file
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+            cells = memoryview(mm)[MAP_HEADER.size:MAP_HEADER.size + length]
+            grid = Grid(sizey, sizex, cells, player=(playery, playerx), seed=seed)
+            grid.layers = _read_layers(memoryview(mm), MAP_HEADER.size + length, sizey, sizex, path, grid.levels)
+            return grid
+        with span('load.read'):
+            payload = fin.read(length)
+            layers = fin.read()
+    finally:
+        if fin is not None:
+            fin.close()
+    if len(payload) < length:
+        raise ValueError('truncated map file: ' + path)
+    with span('load.decompress', compression=compression):
+        layers = _read_layers(layers, 0, sizey, sizex, path)
+        if compression == COMPRESS_CHUNKED:
+            chunks = ChunkFileGrid(path, io.BytesIO(payload), 0, sizey, sizex, (playery, playerx), seed)
+            payload = chunks.tobytes()
+        elif compression == COMPRESS_ZLIB:
+            payload = zlib.decompress(payload)
+        elif compression != COMPRESS_NONE:
+            raise ValueError('unknown map compression ' + str(compression) + ': ' + path)
+    if len(payload) != sizey * sizex:
+        raise ValueError('map size does not match header: ' + path)
+    grid = Grid(sizey, sizex, bytearray(payload), player=(playery, playerx), seed=seed)
+    grid.layers = layers
+    return grid
+
+# Save game_objects to a map file at path
 def save_map(path, game_objects):
-    # Inialize load bar window and values
+    # Inialize load bar window
     loadwin = curses.newwin(MAP_HEIGHT, MAP_WIDTH, 0, 0)
-    loadvalue = 1
-    loadmax = len(game_objects.keys())
     loadwin.clear()
+    loadwin.border(0)
     loadwin.refresh()
-    # Converts tiles data structure into a json safe writable data structure
-    go = {'mapsize': game_objects['mapsize'], 'player': game_objects['player']}
-    for key in game_objects.keys():
-        if key == "player" or key == "mapsize":
-            continue
-        go[key] = tile_to_json(game_objects[key])
-        # Load bar
-        percent = int((loadvalue / loadmax) * 100)
-        loadvalue += 1
-        loadwin.addstr(1, 1, '[Converting objects to file format] -> ' + str(percent) + '%')
-        loadwin.border(0)
-        loadwin.refresh()
-    # Values for loading bars
-    loadvalue = 1
-    loadmax = len(game_objects.keys())
-    loadwin.addstr(2, 1, '[Compressing and writing '+path+']')
-    loadwin.refresh()
+    progress = Progress(curses_progress(loadwin), SAVE_STAGES)
     dirs = ['resources', 'resources/maps', 'resources/html_maps']
     for dir in dirs:
         try:
             os.mkdir(dir)
         except:
             pass
-    # Compress, json, and write the data structure to a file
-    with gzip.GzipFile(path, 'w') as fout:
-        fout.write(json.dumps(go).encode('utf-8'))
+    write_map(path, game_objects, progress=progress)
     # Wait for user input
-    loadwin.addstr(3, 1, 'press enter to continue...')
+    loadwin.addstr(progress_lines(progress), 1, 'press enter to continue...')
     c = loadwin.getch()
     loadwin.clear()
     loadwin.refresh()
     del loadwin
 
-# Load compressed json file, return as game_objects
+# Load a map file of any format, return as game_objects
 def load_map(path):
-    # Inialize load bar window and values
+    # Inialize load bar window
     loadwin = curses.newwin(MAP_HEIGHT, MAP_WIDTH, 0, 0)
     loadwin.clear()
     loadwin.border(0)
-    loadwin.addstr(1, 1, '[Decompressing and loading '+path+']')
     loadwin.refresh()
-    # Decompress, store json into game_objects
-    with gzip.GzipFile(path) as fin:
-        go = json.loads(fin.read().decode('utf-8'))
-    game_objects = {'mapsize': go['mapsize'], 'player': go['player']}
-    # Inialize load bar window and values
-    loadvalue = 1
-    loadmax = len(go.keys()) - 2
-    # Convert json object data into tile objects and store them in game_objects
-    for key in go.keys():
-        if key == "player" or key == "mapsize":
-            continue
-        game_objects[key] = json_to_tile(go[key])
-        # Load bar
-        percent = int((loadvalue / loadmax) * 100)
-        loadvalue += 1
-        loadwin.addstr(2, 1, '[Converting data to game objects] -> ' + str(percent) + '%')
-        loadwin.border(0)
-        loadwin.refresh()
+    progress = Progress(curses_progress(loadwin), LOAD_STAGES)
+    game_objects = read_map(path, lazy=True, progress=progress)
     # Wait for user input
-    loadwin.addstr(3, 1, 'press enter to continue...')
+    loadwin.addstr(progress_lines(progress), 1, 'press enter to continue...')
     c = loadwin.getch()
     loadwin.clear()
     loadwin.refresh()
@@ -261,15 +1780,47 @@ def html_map_export(sizey, sizex, game_objects):
     dateobj = datetime.now()
     date = dateobj.strftime('%y-%m-%d-%H-%M-%S')
     filename = 'resources/html_maps/map-' + date + '.html'
-    f = open(filename, 'w')
-    f.write('<!DOCTYPE html>\n<html>\n<head>\n<style>body{font-family: monospace; font-size: 10px;}</style>\n</head>\n<body>')
-    for y in range(-sizey, sizey):
-        if y != -sizey:
-            f.write('\n')
-        for x in range(-sizex, sizex):
-            f.write(game_objects['tiles'][(y,x)].ch)
-    f.write('</body>\n</html>')
-    f.close()
+    export_map(filename, game_objects, 'html')
+    return filename
+
+# Write a map as 'html', 'text' (one line of tile chars per row) or 'png', by default the format comes from the
+# file extension. Rows are taken EXPORT_ROWS at a time so chunked maps are exported without loading them whole
+def export_map(path, game_objects, fmt=None):
+    if fmt is None:
+        fmt = EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt not in EXPORT_FORMATS.values():
+        raise ValueError('unknown export format: ' + str(fmt))
+    with open(path, 'wb') as fout:
+        if fmt == 'png':
+            _export_png(fout, game_objects)
+            return
+        if fmt == 'html':
+            fout.write(HTML_HEAD.encode('ascii'))
+        for y0 in range(0, game_objects.sizey, EXPORT_ROWS):
+            rows = b'\n'.join(game_objects.row(y) for y in range(y0, min(game_objects.sizey, y0 + EXPORT_ROWS)))
+            if fmt == 'html':
+                rows = html.escape(rows.decode('latin-1'), quote=False).encode('latin-1')
+            fout.write(rows + b'\n')
+        if fmt == 'html':
+            fout.write(HTML_TAIL.encode('ascii'))
+
+# Palette png, each band of rows becomes pixels with one bytes.translate (the row filter bytes included) and is
+# fed to a single zlib stream written out as IDAT chunks
+def _export_png(fout, game_objects):
+    def chunk(kind, data):
+        fout.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+    fout.write(PNG_MAGIC)
+    # Width, height, 8 bit depth, colour type 3 (palette), default compression, filter and interlace
+    chunk(b'IHDR', struct.pack('>IIBBBBB', game_objects.sizex, game_objects.sizey, 8, 3, 0, 0, 0))
+    chunk(b'PLTE', PNG_PALETTE)
+    stream = zlib.compressobj(MAP_ZLIB_LEVEL)
+    for y0 in range(0, game_objects.sizey, EXPORT_ROWS):
+        rows = [game_objects.row(y) for y in range(y0, min(game_objects.sizey, y0 + EXPORT_ROWS))]
+        data = stream.compress((b'\x00' + b'\x00'.join(rows)).translate(PNG_TABLE))
+        if data:
+            chunk(b'IDAT', data)
+    chunk(b'IDAT', stream.flush())
+    chunk(b'IEND', b'')
 
 # Main menu for selecting program action
 def menu():
@@ -286,7 +1837,8 @@ def menu():
         menu.border(0)
         menu.addstr(1, 1, 'G - generate new map')
         menu.addstr(2, 1, 'L - load map')
-        menu.addstr(3, 1, 'Q - quit program')
+        menu.addstr(3, 1, 'E - explore endless map')
+        menu.addstr(4, 1, 'Q - quit program')
         menu.refresh()
         c = menu.getch()
         curses.flushinp() # clear other things besides getch?
@@ -301,7 +1853,8 @@ def menu():
             size = get_map_size()
             mapsizey = size
             mapsizex = size
-            game_objects = gen_map(mapsizey, mapsizex, midy, midx)
+            # A seeded map can be generated again from the seed stored in its file
+            game_objects = gen_map(mapsizey, mapsizex, midy, midx, seed=random.getrandbits(32))
             menu.clear()
             menu.refresh()
             save_map(path, game_objects)
@@ -329,6 +1882,11 @@ def menu():
                 menu.addstr(MAP_HEIGHT-2, 1, 'error: failed to load map file (possible corruption?)')
                 continue
             """
+        elif c == ord('e') or c == ord('E'):
+            # endless map, chunks are generated while moving around so there is nothing to wait for
+            midy = int(MAP_HEIGHT / 2)
+            midx = int(MAP_WIDTH / 2)
+            game_objects = StreamGrid(random.getrandbits(32), midy, midx)
         elif c == ord('q') or c == ord('Q'):
             exit(0)
         menu.clear()
@@ -392,7 +1950,7 @@ def get_map_size():
         curses.curs_set(True)
         menu.move(2, len(strsize)+1)
         menu.border(0)
-        menu.addstr(1,1, 'Size of map must be 50 or greater. (300 == 5+min)')
+        menu.addstr(1,1, 'Size of map must be 50 or greater.')
         menu.addstr(2,1,strsize)
         menu.refresh()
         s = menu.getstr(2, len(strsize)+1)
@@ -464,10 +2022,202 @@ def load_map_path():
         time.sleep(2)
         return path
 
+# Maps generated and saved by worker processes while the viewer keeps running. Workers send (job, kind, data)
+# messages on a queue: 'progress' with a short status, then 'done' with the path or 'error' with the reason.
+# poll() takes in the messages without waiting, for the curses loop to call between keys
+class BackgroundJobs:
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        # job number -> [process, path, status, finished]
+        self.jobs = OrderedDict()
+
+    def generate(self, path, size, seed, midy, midx):
+        job = len(self.jobs) + 1
+        # Not a daemon, the worker may start a pool of its own for the voronoi stage (GEN_WORKERS > 1). close()
+        # stops it when the viewer quits
+        process = multiprocessing.Process(target=_background_generate, args=(self.queue, job, path, size, seed,
+                                                                             midy, midx))
+        process.start()
+        self.jobs[job] = [process, path, 'starting', False]
+        return job
+
+    # Handle waiting messages, returns True when the status of a job changed
+    def poll(self):
+        changed = False
+        while True:
+            try:
+                job, kind, data = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            state = self.jobs[job]
+            if kind == 'progress':
+                state[2] = data
+            elif kind == 'done':
+                state[2] = 'saved ' + os.path.basename(data)
+                state[3] = True
+            else:
+                state[2] = 'error: ' + data
+                state[3] = True
+            changed = True
+        # A worker that died without a word (killed, out of memory)
+        for state in self.jobs.values():
+            if not state[3] and not state[0].is_alive() and state[0].exitcode != 0 and self.queue.empty():
+                state[2] = 'error: worker exit ' + str(state[0].exitcode)
+                state[3] = True
+                changed = True
+        return changed
+
+    def running(self):
+        return sum(1 for state in self.jobs.values() if not state[3])
+
+    # Status of the newest job, '' when nothing was started
+    def status(self):
+        if not self.jobs:
+            return ''
+        return next(reversed(self.jobs.values()))[2]
+
+    # Stop running workers, the maps they were writing are left as they were before
+    def close(self):
+        for process, path, status, finished in self.jobs.values():
+            if process.is_alive():
+                process.terminate()
+                process.join()
+                temp = temp_map_path(path, process.pid)
+                if os.path.exists(temp):
+                    os.remove(temp)
+
+def _background_stop(signum, frame):
+    sys.exit(1)
+
+# Body of a BackgroundJobs worker process: generate a map from seed and save it to path
+def _background_generate(messages, job, path, size, seed, midy, midx):
+    # close() terminates the worker, leave through the finally blocks so a voronoi pool, its shared memory and a
+    # half written map are all cleaned up
+    signal.signal(signal.SIGTERM, _background_stop)
+    def sink(progress):
+        for name, (label, done, total) in progress.stages.items():
+            if done < total:
+                messages.put((job, 'progress', name + ' ' + str(progress.percent(name)) + '%'))
+                return
+    progress = Progress(sink, generate_stages() + SAVE_STAGES)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        game_objects = generate_map(size, size, midy, midx, progress=progress, seed=seed)
+        write_map(path, game_objects, progress=progress)
+    except Exception as e:
+        messages.put((job, 'error', str(e)))
+        return
+    messages.put((job, 'done', path))
+
+# Draws the visible part of a map into a bordered curses window with the player in the middle. Nothing is drawn
+# when the view did not move, a move up or down scrolls the window and only draws the row that came into view,
+# and rows are drawn with one addstr per run of tiles with the same colour
+class MapView:
+    def __init__(self, win, game_objects, midy, midx):
+        self.win = win
+        self.game_objects = game_objects
+        self.midy = midy
+        self.midx = midx
+        self.origin = None
+        self.size = None
+        # Lets curses move lines on the terminal instead of sending them again when the window scrolls
+        win.idlok(True)
+
+    # Forget what is on screen, the next draw redraws everything
+    def invalidate(self):
+        self.origin = None
+
+    # Draw another map (or level of a MapPyramid) from now on
+    def show(self, game_objects):
+        self.game_objects = game_objects
+        self.origin = None
+
+    # Draw the map with (y, x) at the top left corner of the window, returns False when nothing had to change
+    def draw(self, y, x):
+        size = self.win.getmaxyx()
+        if size != self.size:
+            self.size = size
+            self.origin = None
+            self.win.scrollok(True)
+            self.win.setscrreg(1, size[0] - 2)
+        height = size[0]
+        if self.origin == (y, x):
+            return False
+        try:
+            if self.origin is not None and self.origin[1] == x and abs(y - self.origin[0]) < height - 2:
+                shift = y - self.origin[0]
+                self.win.scroll(shift)
+                # Rows that scrolled into view, and the row the old player marker scrolled to
+                if shift > 0:
+                    rows = range(height - 1 - shift, height - 1)
+                else:
+                    rows = range(1, 1 - shift)
+                for wy in rows:
+                    self._draw_row(wy, y + wy, x)
+                if 0 < self.midy - shift < height - 1:
+                    self._draw_row(self.midy - shift, y + self.midy - shift, x)
+            else:
+                for wy in range(1, height - 1):
+                    self._draw_row(wy, y + wy, x)
+            self._draw_row(self.midy, y + self.midy, x)
+            if self.game_objects.in_bounds(y + self.midy, x + self.midx):
+                self.win.addstr(self.midy, self.midx, 'P', curses.color_pair(2))
+            self.win.border(0)
+        except curses.error: # Passing ncurses errors allows for resizing of windows without crashing
+            pass
+        self.origin = (y, x)
+        return True
+
+    # Draw map row ty into window row wy, window columns 1 to width-2 show map columns x+1 to x+width-2
+    def _draw_row(self, wy, ty, x):
+        game_objects = self.game_objects
+        x0 = x + 1
+        x1 = x + self.size[1] - 1
+        lo = x0
+        hi = x1
+        if game_objects.sizex is not None:
+            lo = max(x0, 0)
+            hi = min(x1, game_objects.sizex)
+        if lo >= hi or not game_objects.in_bounds(ty, lo):
+            self.win.addstr(wy, 1, ' ' * (x1 - x0))
+            return
+        if lo > x0:
+            self.win.addstr(wy, 1, ' ' * (lo - x0))
+        wall = ord(WALLCH)
+        for run in ROW_RUNS.finditer(game_objects.row(ty, lo, hi)):
+            colour = curses.color_pair(1) if run.group()[0] == wall else curses.color_pair(3)
+            self.win.addstr(wy, 1 + lo - x0 + run.start(), run.group().decode('ascii'), colour)
+        if hi < x1:
+            self.win.addstr(wy, 1 + hi - x0, ' ' * (x1 - hi))
+
+# Whole map in a small bordered window, from the MapPyramid level that fits in it, with the player marked.
+# Only redrawn when the player moves to another minimap tile
+class MiniMap(MapView):
+    def __init__(self, win, pyramid):
+        height, width = win.getmaxyx()
+        self.zoom = pyramid.fit(height - 2, width - 2)
+        MapView.__init__(self, win, pyramid.level(self.zoom), 0, 0)
+
+    # Mark the player at map tile (y, x), returns False when nothing had to change
+    def draw(self, y, x):
+        size = self.win.getmaxyx()
+        cell = (y >> self.zoom, x >> self.zoom)
+        if size == self.size and cell == self.origin:
+            return False
+        self.size = size
+        try:
+            for wy in range(1, size[0] - 1):
+                self._draw_row(wy, wy - 1, -1)
+            if self.game_objects.in_bounds(cell[0], cell[1]):
+                self.win.addstr(1 + cell[0], 1 + cell[1], 'P', curses.color_pair(2))
+            self.win.border(0)
+        except curses.error:
+            pass
+        self.origin = cell
+        return True
+
 # Giant main function for where the program starts
 def main(stdscr):
-    # Required to be global for buggy resize windows, requires reassignment of values
-    global MAP_HEIGHT, MAP_WIDTH
     y = 1
     x = 1
     midy = int(MAP_HEIGHT / 2) # FIXME: mid points break on too small maps
@@ -482,104 +2232,269 @@ def main(stdscr):
     game_objects = {}
     while not game_objects:
         game_objects = menu()
-    mapsize = game_objects['mapsize']
     # make a second window for getch and for displaying the map, this reduces flickering on getch refreshes
     stats_y = 2
     stats_x = MAP_WIDTH + 2
-    stats = curses.newwin(5, 15, stats_y, MAP_WIDTH + 1)
+    stats = curses.newwin(6, 15, stats_y, MAP_WIDTH + 1)
+    # Maps generated with g while this one stays on screen, and the window showing how far they are
+    background = BackgroundJobs()
+    jobs = curses.newwin(4, 15, stats_y + 6, MAP_WIDTH + 1)
     win = curses.newwin(WIN_HEIGHT, WIN_WIDTH, 0, 0)
     map = curses.newwin(MAP_HEIGHT, MAP_WIDTH, 0, 0)
     map.border(0)
-    map.nodelay(True)
-    win.nodelay(True) # Makes getch non blocking
     win.keypad(True)
     map.keypad(True)
-    # Main ncurses loop, draw map, accept user input, shift map drawing
+    view = MapView(map, game_objects, midy, midx)
+    # Zoom level, the map is drawn from this level of the pyramid and each level halves the map. Maps without a
+    # pyramid (see map_pyramid) have no zoom and no minimap, the stats window says so. The minimap of a lazily
+    # loaded map without stored levels waits for the first zoom out, opening the map does not read all of it
+    zoom = 0
+    pyramid = map_pyramid(game_objects)
+    minimap = None
+    lazy = pyramid is not None and is_lazy_map(game_objects) and not game_objects.levels
+    frame_time = 0.0
+    # Main ncurses loop, wait for user input, move, draw the map when the view changed
     while True:
-        # Get keyboard input
-        c = win.getch()
-        curses.flushinp() # cleans extra getch characters
-        if c == ord('a') or c == curses.KEY_LEFT: # Move left
-            if game_objects[get_yx_key(y+midy,x+midx-1)].ch != WALLCH:
-                x -= 1
-        elif c == ord('d') or c == curses.KEY_RIGHT: # Move right
-            if game_objects[get_yx_key(y+midy,x+midx+1)].ch != WALLCH:
-                x += 1
-        elif c == ord('s') or c == curses.KEY_DOWN: # Move down
-            if game_objects[get_yx_key(y+midy+1,x+midx)].ch != WALLCH:
-                y += 1
-        elif c == ord('w') or c == curses.KEY_UP: # Move up
-            if game_objects[get_yx_key(y+midy-1,x+midx)].ch != WALLCH:
-                y -= 1
-        elif False and c == ord("+"): # Buggy resize of screen (experimental feature, may break stuff)
-            stats.clear()
-            win.clear()
-            map.clear()
-            stdscr.clear()
-            MAP_HEIGHT += 5
-            MAP_WIDTH += 10
-            stats.mvwin(stats_y, MAP_WIDTH + 2)
-            stats.refresh()
-            win.refresh()
-            map.refresh()
-            stdscr.refresh()
-        elif False and c == ord("-"): # Buggy resize of screen (experimental feature, may break stuff)
-            stats.clear()
-            win.clear()
-            map.clear()
-            stdscr.clear()
-            MAP_HEIGHT -= 5
-            MAP_WIDTH -= 10
-            stats.mvwin(stats_y, MAP_WIDTH + 2)
-            stats.refresh()
-            win.refresh()
-            map.refresh()
-            stdscr.refresh()
-        elif c == ord('q') or c == ord('Q'):
-            exit(0)
-        # Draw stats window for position info, etc
-        try:
-            map.clear()
-            stats.clear()
-            stats.addstr(1,1,'pos_x:' + str(x))
-            stats.addstr(2,1,'pos_y:' + str(y))
-        except curses.error: # Passing ncurses errors allows for resizing of windows without crashing
-            pass
-        # Draw main map window, draw visible tiles, draw player
-        for ty in range(y-1, y+MAP_HEIGHT):
-            for tx in range(x-1, x+MAP_WIDTH):
-                # Skip tiles that are outside map viewer
-                if ty >= mapsize['y'] or ty < 0 or tx >= mapsize['x'] or tx < 0:
-                    continue
-                # key is the index for all tiles
-                key = get_yx_key(ty,tx)
-                # Get relative positions to left corner of screen (x,y)
-                go_y = game_objects[key].y - y
-                go_x = game_objects[key].x - x
-                # Draw tiles
+        # Get keyboard input, blocks until a key arrives so an idle map uses no cpu. While background jobs run
+        # the wait is cut short now and then to show their progress
+        win.timeout(BACKGROUND_POLL_MS if background.running() else INPUT_TIMEOUT_MS)
+        keys = [win.getch()]
+        # Keys that arrived while drawing are all handled before the next draw, instead of being thrown away
+        if COALESCE_KEYS:
+            win.timeout(0)
+            c = win.getch()
+            while c != curses.ERR:
+                keys.append(c)
+                c = win.getch()
+        t = time.perf_counter()
+        for c in keys:
+            dy = 0
+            dx = 0
+            if c == ord('a') or c == curses.KEY_LEFT: # Move left
+                dx = -1
+            elif c == ord('d') or c == curses.KEY_RIGHT: # Move right
+                dx = 1
+            elif c == ord('s') or c == curses.KEY_DOWN: # Move down
+                dy = 1
+            elif c == ord('w') or c == curses.KEY_UP: # Move up
+                dy = -1
+            elif c == ord('+') or c == ord('='): # Zoom in
+                if zoom > 0:
+                    zoom -= 1
+                    view.show(pyramid.level(zoom))
+            elif c == ord('-'): # Zoom out
+                if pyramid is not None and zoom < pyramid.depth() - 1:
+                    zoom += 1
+                    view.show(pyramid.level(zoom))
+            elif c == ord('g') or c == ord('G'): # Generate and save a new map in the background
+                path = get_map_path()
+                size = get_map_size()
+                background.generate(path, size, random.getrandbits(32), midy, midx)
+                # The prompts were drawn over the map
+                view.invalidate()
+                map.touchwin()
+            elif c == curses.KEY_RESIZE:
+                view.invalidate()
+                if minimap is not None:
+                    minimap.invalidate()
+            elif c == ord('q') or c == ord('Q'):
+                background.close()
+                exit(0)
+            # Zoomed out a key moves one tile of the shown level, stopping at the first wall on the way
+            for i in range(0, (1 << zoom) if dy or dx else 0):
+                if game_objects[y+midy+dy, x+midx+dx] == WALLCH:
+                    break
+                y += dy
+                x += dx
+        if pyramid is not None and minimap is None and (zoom > 0 or not lazy):
+            minimap = MiniMap(curses.newwin(MINIMAP_HEIGHT, MINIMAP_WIDTH, stats_y + 10, MAP_WIDTH + 1), pyramid)
+        # Draw main map window, then the stats window for position info, etc. Only when the view changed
+        with span('frame', keys=len(keys)):
+            # The player stays in the middle of the window at every zoom level
+            redrawn = view.draw(((y + midy) >> zoom) - midy, ((x + midx) >> zoom) - midx)
+            if redrawn:
                 try:
-                    if (go_y > 0 and go_y < MAP_HEIGHT - 1) and (go_x > 0 and go_x < MAP_WIDTH - 1):
-                        if game_objects[key].ch == WALLCH:
-                            map.addstr(game_objects[key].y - y, game_objects[key].x - x, game_objects[key].ch, curses.color_pair(1))
-                        else:
-                            map.addstr(game_objects[key].y - y, game_objects[key].x - x, game_objects[key].ch, curses.color_pair(3))
-                    if go_y == midy and go_x == midx:
-                        map.addstr(go_y, go_x, 'P', curses.color_pair(2))
+                    stats.erase()
+                    stats.addstr(1,1,'pos_x:' + str(x))
+                    stats.addstr(2,1,'pos_y:' + str(y))
+                    stats.addstr(3,1,'zoom:1/' + str(1 << zoom) if pyramid is not None else 'zoom:n/a')
+                    stats.addstr(4,1,'frame:' + '%.1f' % (frame_time * 1000) + 'ms')
+                    stats.border(0)
                 except curses.error: # Passing ncurses errors allows for resizing of windows without crashing
                     pass
-        # Window cleanup for screen update and resizing
-        map.border(0)
-        map.resize(MAP_HEIGHT, MAP_WIDTH)
-        stats.resize(5,15)
-        stats.border(0)
-        # Fake refresh, prepares data structures but does not change screen
-        stats.noutrefresh()
-        map.noutrefresh()
-        time.sleep(0.1)
-        # Doupdate redraws the screen
-        if c != curses.ERR or curses.KEY_RESIZE:
-            curses.doupdate()
+                # Fake refresh, prepares data structures but does not change screen
+                stats.noutrefresh()
+                map.noutrefresh()
+                if minimap is not None and minimap.draw(y + midy, x + midx):
+                    minimap.win.noutrefresh()
+                # Doupdate redraws the screen
+                curses.doupdate()
+                # Time from reading the keys to the screen being updated, shown on the next frame
+                frame_time = time.perf_counter() - t
+            # The jobs window, when a job reported back or the map window was drawn over it
+            if (background.poll() or redrawn) and background.jobs:
+                try:
+                    jobs.erase()
+                    jobs.addstr(1,1,'jobs:' + str(background.running()))
+                    jobs.addstr(2,1,background.status()[:13])
+                    jobs.border(0)
+                except curses.error:
+                    pass
+                jobs.refresh()
+
+# Generate and save one map for the batch cli, returns its timing stats. Runs in worker processes with --jobs.
+# With a cache directory the map is taken from (or generated into) a MapCache there instead of written to path.
+# With profile this map's generation is profiled to that file. With trace the spans recorded while tracing are
+# handed back under 'trace', for the parent process to merge into its own trace
+def _batch_generate(path, size, seed, fmt, compression, workers, connect, fields, cache=None, show_progress=False,
+                    profile=None, trace=False):
+    global PROFILE_PATH
+    if profile is not None:
+        PROFILE_PATH = profile
+    progress = Progress(stderr_progress if show_progress else None, generate_stages(connect, fields) + SAVE_STAGES)
+    midy = int(MAP_HEIGHT / 2)
+    midx = int(MAP_WIDTH / 2)
+    t = time.perf_counter()
+    if cache is not None:
+        maps = MapCache(cache)
+        game_objects = maps.get(seed, size, size, midy, midx, connect, fields, workers, progress)
+        path = maps.map_path(maps.key(seed, size, size, midy, midx, connect, fields))
+    else:
+        game_objects = generate_map(size, size, midy, midx, workers, progress, connect, fields, seed)
+    gen_time = time.perf_counter() - t
+    t = time.perf_counter()
+    if cache is None:
+        write_map(path, game_objects, fmt, compression, progress)
+    save_time = time.perf_counter() - t
+    if show_progress:
+        sys.stderr.write('\n')
+    stats = {'path': path, 'size': size, 'seed': seed, 'generator': GENERATOR_VERSION, 'generate_s': gen_time,
+             'save_s': save_time, 'bytes': os.path.getsize(path), 'cached': cache is not None and maps.hits > 0,
+             'regions': game_objects.region_stats}
+    if trace and TRACER is not None:
+        stats['trace'] = TRACER.take()
+    return stats
+
+# Start of a --jobs worker process: tracing reports to a tracer starting at trace_start (None when tracing is off)
+# and nothing is profiled unless _batch_generate is asked to
+def _batch_worker_init(trace_start):
+    global TRACER, PROFILE_PATH
+    TRACER = None if trace_start is None else Tracer(None, trace_start)
+    PROFILE_PATH = None
+
+# maps.py generate: headless batch map generation, progress goes to stderr and timing stats to stdout as json
+def cli_generate(args):
+    if args.size < 50:
+        sys.stderr.write('error: --size must be >= 50\n')
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+    seed = args.seed if args.seed is not None else random.getrandbits(32)
+    if seed + args.count > SEED_LIMIT:
+        sys.stderr.write('error: --seed + --count goes past the largest seed ' + str(SEED_LIMIT - 1) + '\n')
+        return 2
+    compression = MAP_COMPRESSION if args.compression is None else COMPRESSIONS[args.compression]
+    jobs = []
+    for i in range(0, args.count):
+        path = os.path.join(args.out, 'map-' + str(args.size) + '-' + str(seed+i) + '.map')
+        jobs.append((path, args.size, seed+i, args.format, compression, args.workers, args.connect, args.fields,
+                     args.cache))
+    stats = []
+    def report(result):
+        events = result.pop('trace', None)
+        if events:
+            TRACER.events.extend(events)
+        stats.append(result)
+        sys.stderr.write('[' + str(len(stats)) + '/' + str(len(jobs)) + '] ' + result['path'] + ' ' +
+                         '%.3fs' % (result['generate_s'] + result['save_s']) + '\n')
+    t = time.perf_counter()
+    if args.jobs <= 1:
+        for job in jobs:
+            report(_batch_generate(*job, show_progress=True))
+    else:
+        # Only the first map is profiled, the worker processes send their trace spans back with their stats
+        trace_start = None if TRACER is None else TRACER.start
+        with ProcessPoolExecutor(args.jobs, initializer=_batch_worker_init, initargs=(trace_start,)) as pool:
+            futures = [pool.submit(_batch_generate, *job, profile=PROFILE_PATH if i == 0 else None, trace=True)
+                       for i, job in enumerate(jobs)]
+            for done in as_completed(futures):
+                report(done.result())
+    total = time.perf_counter() - t
+    stats.sort(key=lambda m: m['seed'])
+    json.dump({'maps': stats, 'count': len(stats), 'total_s': total, 'maps_per_s': len(stats) / total if total else 0.0},
+              sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+# maps.py convert: convert a map file between the json and v2 formats
+def cli_convert(args):
+    compression = None if args.compression is None else COMPRESSIONS[args.compression]
+    convert_map(args.src, args.dst, args.format, compression)
+    return 0
+
+# maps.py export: write a map file as html, text or png
+def cli_export(args):
+    export_map(args.dst, read_map(args.src, lazy=True), args.format)
+    return 0
+
+# argparse type of seed options
+def seed_arg(text):
+    try:
+        return check_seed(int(text))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+# Command line entry point, with no command the curses program starts like it always has
+def cli(argv):
+    parser = argparse.ArgumentParser(prog='maps.py', description='Voronoi map generator and curses map viewer')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a chrome trace of timed spans to FILE and print a summary (or set ' + TRACE_ENV + ')')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save a cProfile of the first map generation to FILE (or set ' + PROFILE_ENV + ')')
+    commands = parser.add_subparsers(dest='command')
+    gen = commands.add_parser('generate', help='generate maps without the curses interface')
+    gen.add_argument('--size', type=int, required=True, help='width and height of each map (>= 50)')
+    gen.add_argument('--count', type=int, default=1, help='number of maps to generate')
+    gen.add_argument('--seed', type=seed_arg, help='random seed of the first map, the next maps use seed+1, seed+2, ...')
+    gen.add_argument('--out', default='resources/maps', help='directory the maps are written to')
+    gen.add_argument('--jobs', type=int, default=1, help='maps generated at the same time in separate processes')
+    gen.add_argument('--workers', type=int, default=1, help='processes used for the voronoi stage of each map')
+    gen.add_argument('--connect', action='store_true', default=CONNECT_MAP,
+                     help='carve corridors joining every floor region to the spawn')
+    gen.add_argument('--fields', action='store_true', default=DISTANCE_FIELDS,
+                     help='store spawn and wall distance layers with each map (v2 only)')
+    gen.add_argument('--cache', nargs='?', const=MAP_CACHE_DIR,
+                     help='take maps from a map cache directory (' + MAP_CACHE_DIR + ' by default), generating and '
+                          'caching only the ones that are missing, instead of writing them to --out')
+    gen.add_argument('--format', choices=('v2', 'json'), default=MAP_FORMAT)
+    gen.add_argument('--compression', choices=sorted(COMPRESSIONS))
+    gen.set_defaults(func=cli_generate)
+    conv = commands.add_parser('convert', help='convert a map file between the json and v2 formats')
+    conv.add_argument('src')
+    conv.add_argument('dst')
+    conv.add_argument('--format', choices=('v2', 'json'), required=True)
+    conv.add_argument('--compression', choices=sorted(COMPRESSIONS))
+    conv.set_defaults(func=cli_convert)
+    export = commands.add_parser('export', help='export a map file as html, text or png')
+    export.add_argument('src')
+    export.add_argument('dst', help='output file, the format comes from its extension unless --format is given')
+    export.add_argument('--format', choices=('html', 'text', 'png'))
+    export.set_defaults(func=cli_export)
+    args = parser.parse_args(argv)
+    trace = args.trace or os.environ.get(TRACE_ENV)
+    global PROFILE_PATH
+    PROFILE_PATH = args.profile or os.environ.get(PROFILE_ENV)
+    if trace:
+        start_trace(trace)
+    try:
+        if args.command is None:
+            wrapper(main)
+            return 0
+        return args.func(args)
+    finally:
+        # Also when the viewer quits with exit(), after curses has given the terminal back
+        if trace:
+            sys.stderr.write(stop_trace())
 
 # Wrapper starts ncurses program, and fixes terminal glitches at end of program
 if __name__ == '__main__':
-    wrapper(main)
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from maps import (Grid, NEIGHBOR_DOWN, NEIGHBOR_LEFT, NEIGHBOR_RIGHT, NEIGHBOR_UP, Progress, Tile, WALLCH,
+                  _floor_regions, read_map)
+
+# Default search used by find_path, 'jps' (jump point search) or 'astar'
+PATH_METHOD = 'jps'
+PATH_METHODS = ('jps', 'astar')
+# In a batch, a start with at least this many goals is answered with one breadth first search instead of one search per goal
+BATCH_BFS_GOALS = 2
+BENCH_QUERIES = 1000
+BENCH_MAPS = ('resources/maps/50x50.map', 'resources/maps/100x100.map', 'resources/maps/200x200.map')
+
+# Walkable tiles of a map, with the connected components labelled up front so unreachable goals fail instantly.
+# Takes a Grid (or any grid with sizey, sizex, row, tobytes and neighbor_mask) or the old game_objects dict of tiles.
+# Cells are padded with a border of walls, cell index = (y + 1) * width + x + 1, so searches never check bounds.
+# Paths only move up, down, left and right like the player, and are lists of (y, x) from start to goal.
+class PathGrid:
+    def __init__(self, game_objects):
+        size = game_objects['mapsize']
+        self.sizey = size['y']
+        self.sizex = size['x']
+        self.width = self.sizex + 2
+        if not hasattr(game_objects, 'neighbor_mask'):
+            game_objects = self._to_grid(game_objects)
+        # Wall bytes become 0 and every other tile char 1
+        table = bytes(0 if c == ord(WALLCH) else 1 for c in range(0, 256))
+        self.walk = self._pad(game_objects.tobytes().translate(table))
+        # NEIGHBOR_* bits of the walkable cells next to each cell, what the searches expand
+        self.moves = self._pad(game_objects.neighbor_mask())
+        self.steps = ((NEIGHBOR_RIGHT, 1), (NEIGHBOR_LEFT, -1), (NEIGHBOR_DOWN, self.width),
+                      (NEIGHBOR_UP, -self.width))
+        self.components, self.component_sizes = self._label(game_objects)
+
+    # Grid of the tiles in an old game_objects dict, tiles built by the program or the json dicts of a map file
+    def _to_grid(self, game_objects):
+        grid = Grid(self.sizey, self.sizex)
+        for key, tile in game_objects.items():
+            if key == 'player' or key == 'mapsize':
+                continue
+            if isinstance(tile, Tile):
+                y, x, ch = tile.y, tile.x, tile.ch
+            else:
+                y, x, ch = tile['y'], tile['x'], tile['c']
+            if grid.in_bounds(y, x):
+                grid[y, x] = ch
+        return grid
+
+    # Copy of one byte per tile values with the wall border around them
+    def _pad(self, cells):
+        padded = bytearray(self.width * (self.sizey + 2))
+        for y in range(0, self.sizey):
+            start = (y + 1) * self.width + 1
+            padded[start:start+self.sizex] = cells[y*self.sizex:(y+1)*self.sizex]
+        return padded
+
+    # Connected component of every cell (0 for walls) and the tile count of each component, from the runs of floor
+    # that connect_map also labels
+    def _label(self, game_objects):
+        components = array('I', bytes(4 * len(self.walk)))
+        sizes = [0]
+        runs, labels = _floor_regions(game_objects, Progress())
+        for (start, end), label in zip(runs, labels):
+            y, x = divmod(start, self.sizex)
+            i = (y + 1) * self.width + x + 1
+            components[i:i+end-start] = array('I', [label]) * (end - start)
+            while len(sizes) <= label:
+                sizes.append(0)
+            sizes[label] += end - start
+        return components, sizes
+
+    # Cell index of a (y, x) position or 'YxX' tile key, None when it is off the map or a wall
+    def index(self, pos):
+        if isinstance(pos, str):
+            y, x = (int(n) for n in pos.split('x'))
+        else:
+            y, x = pos
+        if not (0 <= y < self.sizey and 0 <= x < self.sizex):
+            return None
+        i = (y + 1) * self.width + x + 1
+        if not self.walk[i]:
+            return None
+        return i
+
+    def position(self, i):
+        y, x = divmod(i, self.width)
+        return y - 1, x - 1
+
+    def component(self, pos):
+        i = self.index(pos)
+        if i is None:
+            return 0
+        return self.components[i]
+
+    def connected(self, start, goal):
+        c = self.component(start)
+        return c != 0 and c == self.component(goal)
+
+    # Shortest path from start to goal, None when there is none
+    def find_path(self, start, goal, method=None):
+        s = self.index(start)
+        g = self.index(goal)
+        if s is None or g is None or self.components[s] != self.components[g]:
+            return None
+        if s == g:
+            return [self.position(s)]
+        if method is None:
+            method = PATH_METHOD
+        if method == 'jps':
+            return self._jps(s, g)
+        if method == 'astar':
+            return self._astar(s, g)
+        raise ValueError('unknown path method: ' + str(method))
+
+    # Answer many (start, goal) queries in one call, returns a path or None for each query in order.
+    # Queries that share a start are answered from a single breadth first search
+    def find_paths(self, queries, method=None):
+        paths = [None] * len(queries)
+        starts = dict()
+        for q, (start, goal) in enumerate(queries):
+            s = self.index(start)
+            g = self.index(goal)
+            if s is None or g is None or self.components[s] != self.components[g]:
+                continue
+            starts.setdefault(s, []).append((q, g))
+        for s, goals in starts.items():
+            if len(goals) < BATCH_BFS_GOALS:
+                for q, g in goals:
+                    paths[q] = self.find_path(self.position(s), self.position(g), method)
+                continue
+            parents = self._bfs(s, set(g for q, g in goals))
+            for q, g in goals:
+                paths[q] = self._unwind(parents, g)
+        return paths
+
+    # Manhattan distance between two cells
+    def _distance(self, a, b):
+        ay, ax = divmod(a, self.width)
+        by, bx = divmod(b, self.width)
+        return abs(ay - by) + abs(ax - bx)
+
+    def _unwind(self, parents, i):
+        path = [self.position(i)]
+        while parents[i] != i:
+            i = parents[i]
+            path.append(self.position(i))
+        path.reverse()
+        return path
+
+    # Breadth first search from s until every cell in goals is reached, returns the parent of each cell seen
+    def _bfs(self, s, goals):
+        moves = self.moves
+        steps = self.steps
+        parents = {s: s}
+        left = len(goals) - (s in goals)
+        frontier = [s]
+        while frontier and left:
+            reached = []
+            for i in frontier:
+                for bit, step in steps:
+                    j = i + step
+                    if moves[i] & bit and j not in parents:
+                        parents[j] = i
+                        reached.append(j)
+                        if j in goals:
+                            left -= 1
+            frontier = reached
+        return parents
+
+    def _astar(self, s, g):
+        moves = self.moves
+        steps = self.steps
+        distance = self._distance
+        parents = {s: s}
+        costs = {s: 0}
+        # Ties on f are broken towards the deepest node, which heads straight for the goal on open floor
+        heap = [(distance(s, g), 0, s)]
+        while heap:
+            f, cost, i = heapq.heappop(heap)
+            if i == g:
+                return self._unwind(parents, i)
+            cost = -cost
+            if cost > costs[i]:
+                continue
+            cost += 1
+            for bit, step in steps:
+                j = i + step
+                if moves[i] & bit and cost < costs.get(j, cost + 1):
+                    costs[j] = cost
+                    parents[j] = i
+                    heapq.heappush(heap, (cost + distance(j, g), -cost, j))
+        return None
+
+    # Jump point search for 4 way movement. Paths are kept in a canonical order (vertical moves first, then horizontal)
+    # so only jump points are pushed on the heap: cells where a search moving horizontally has to turn because a wall
+    # stopped the vertical move from happening earlier, and cells where a vertical scan can see such a cell sideways.
+    # Search states are (cell, direction) since the directions explored from a cell depend on how it was reached
+    def _jps(self, s, g):
+        walk = self.walk
+        width = self.width
+        distance = self._distance
+        start = (s, 0)
+        parents = {start: start}
+        costs = {start: 0}
+        heap = [(distance(s, g), 0, s, 0)]
+        while heap:
+            f, cost, i, d = heapq.heappop(heap)
+            if i == g:
+                return self._jps_path(parents, (i, d))
+            cost = -cost
+            if cost > costs[(i, d)]:
+                continue
+            if d == 0:
+                dirs = (1, -1, width, -width)
+            elif d == 1 or d == -1:
+                dirs = [d]
+                for v in (width, -width):
+                    if walk[i + v] and not walk[i + v - d]:
+                        dirs.append(v)
+            else:
+                dirs = (d, 1, -1)
+            for step in dirs:
+                if step == 1 or step == -1:
+                    j = self._jump_horizontal(i, step, g)
+                else:
+                    j = self._jump_vertical(i, step, g)
+                if j < 0:
+                    continue
+                jcost = cost + abs(j - i) // abs(step)
+                state = (j, step)
+                if jcost < costs.get(state, jcost + 1):
+                    costs[state] = jcost
+                    parents[state] = (i, d)
+                    heapq.heappush(heap, (jcost + distance(j, g), -jcost, j, step))
+        return None
+
+    # Next jump point moving horizontally from i, or -1 when a wall is hit first
+    def _jump_horizontal(self, i, step, g):
+        walk = self.walk
+        width = self.width
+        while True:
+            i += step
+            if not walk[i]:
+                return -1
+            if i == g:
+                return i
+            # A vertical neighbour that could not be reached by moving vertically before this column
+            if (walk[i - width] and not walk[i - width - step]) or (walk[i + width] and not walk[i + width - step]):
+                return i
+
+    # Next jump point moving vertically from i, or -1 when a wall is hit first
+    def _jump_vertical(self, i, step, g):
+        walk = self.walk
+        while True:
+            i += step
+            if not walk[i]:
+                return -1
+            if i == g:
+                return i
+            if self._jump_horizontal(i, 1, g) >= 0 or self._jump_horizontal(i, -1, g) >= 0:
+                return i
+
+    # Fill in the straight runs between the jump points of a jps result
+    def _jps_path(self, parents, state):
+        jumps = [state[0]]
+        while parents[state] != state:
+            state = parents[state]
+            jumps.append(state[0])
+        jumps.reverse()
+        path = [self.position(jumps[0])]
+        for a, b in zip(jumps, jumps[1:]):
+            step = 1 if abs(b - a) < self.width else self.width
+            if b < a:
+                step = -step
+            for i in range(a + step, b + step, step):
+                path.append(self.position(i))
+        return path
+
+# Shortest path between two (y, x) positions or tile keys on a map, None if the goal can not be reached.
+# game_objects can be a map (Grid or game_objects dict) or a PathGrid, build the PathGrid once when making many queries
+def find_path(game_objects, start, goal, method=None):
+    if not isinstance(game_objects, PathGrid):
+        game_objects = PathGrid(game_objects)
+    return game_objects.find_path(start, goal, method)
+
+# Paths for a list of (start, goal) queries, see PathGrid.find_paths
+def find_paths(game_objects, queries, method=None):
+    if not isinstance(game_objects, PathGrid):
+        game_objects = PathGrid(game_objects)
+    return game_objects.find_paths(queries, method)
+
+# Time the path searches on a map file, random floor to floor queries with a fixed seed
+def benchmark(path, queries, seed):
+    game_objects = read_map(path)
+    t = time.perf_counter()
+    grid = PathGrid(game_objects)
+    build = time.perf_counter() - t
+    floor = [grid.position(i) for i in range(0, len(grid.walk)) if grid.walk[i]]
+    rng = random.Random(seed)
+    pairs = [(rng.choice(floor), rng.choice(floor)) for n in range(0, queries)]
+    stats = {'map': path, 'size': [grid.sizey, grid.sizex], 'floor': len(floor),
+             'components': len(grid.component_sizes) - 1, 'largest': max(grid.component_sizes),
+             'queries': queries, 'reachable': sum(1 for s, g in pairs if grid.connected(s, g)), 'build_s': build}
+    lengths = dict()
+    for method in PATH_METHODS:
+        t = time.perf_counter()
+        found = [grid.find_path(s, g, method) for s, g in pairs]
+        stats[method + '_s'] = time.perf_counter() - t
+        lengths[method] = [None if p is None else len(p) for p in found]
+    # Many queries from one start, the common case for monsters heading for the player
+    rng.shuffle(floor)
+    batch = [(floor[n % 10], g) for n, (s, g) in enumerate(pairs)]
+    t = time.perf_counter()
+    found = grid.find_paths(batch)
+    stats['batch_s'] = time.perf_counter() - t
+    single = [grid.find_path(s, g, 'astar') for s, g in batch]
+    lengths['batch'] = [None if p is None else len(p) for p in found]
+    lengths['batch_astar'] = [None if p is None else len(p) for p in single]
+    stats['mismatches'] = sum(1 for a, b in zip(lengths['jps'], lengths['astar']) if a != b) + \
+        sum(1 for a, b in zip(lengths['batch'], lengths['batch_astar']) if a != b)
+    for key in ('astar', 'jps', 'batch'):
+        stats[key + '_queries_per_s'] = queries / stats[key + '_s'] if stats[key + '_s'] else 0.0
+    return stats
+
+# pathfinding.py [maps...]: benchmark the searches on the bundled maps, stats are written to stdout as json
+def cli(argv):
+    parser = argparse.ArgumentParser(prog='pathfinding.py', description='Benchmark path searches on map files')
+    parser.add_argument('maps', nargs='*', default=BENCH_MAPS, help='map files, the bundled maps by default')
+    parser.add_argument('--queries', type=int, default=BENCH_QUERIES, help='random queries per map and method')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    args = parser.parse_args(argv)
+    results = []
+    for path in args.maps:
+        if not os.path.exists(path):
+            sys.stderr.write('error: no such map: ' + path + '\n')
+            return 2
+        results.append(benchmark(path, args.queries, args.seed))
+        sys.stderr.write(path + ' jps %.1f/s astar %.1f/s batch %.1f/s\n' % (
+            results[-1]['jps_queries_per_s'], results[-1]['astar_queries_per_s'], results[-1]['batch_queries_per_s']))
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))